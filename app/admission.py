@@ -0,0 +1,98 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+from excel_processor import count_rows
+
+
+def default_memory_budget() -> int:
+    """80% of the container's cgroup memory limit, or of the physical memory."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as limit_file:
+                limit = limit_file.read().strip()
+        except OSError:
+            continue
+        # "max" or a huge number when the container has no limit
+        if limit.isdigit() and int(limit) < 1 << 60:
+            return int(int(limit) * 0.8)
+    return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.8)
+
+
+# Memory that the pipeline runs of all server processes may use together;
+# a job is only started when its estimated peak fits next to the running
+# ones (a job estimated above the budget runs alone). 0 disables the limit.
+MEMORY_BUDGET_BYTES = int(os.environ.get("MEMORY_BUDGET_BYTES", str(default_memory_budget())))
+# Jobs a server process keeps waiting for memory before /jobs answers 429
+ADMISSION_QUEUE_LIMIT = int(os.environ.get("ADMISSION_QUEUE_LIMIT", "20"))
+# Retry-After of the 429 and 503 answers
+ADMISSION_RETRY_SECONDS = int(os.environ.get("ADMISSION_RETRY_SECONDS", "30"))
+
+# Estimate of the peak RSS of a run until enough runs have been measured:
+# the worker's baseline plus a share per row (about 145 MiB and 3.4 KiB
+# measured on synthetic files of 300 to 200k rows)
+DEFAULT_BASE_RSS_BYTES = 160 * 1024 * 1024
+DEFAULT_RSS_PER_ROW = 4 * 1024
+# Upload bytes per row, for workbooks that do not declare their size
+DEFAULT_INPUT_BYTES_PER_ROW = 100
+# Measured runs the estimate is fitted on, and the least needed to do so
+CALIBRATION_SAMPLES = 50
+MIN_CALIBRATION_SAMPLES = 5
+
+
+class MemoryEstimator:
+    """
+    Estimates the peak RSS of a pipeline run from the row count of the
+    upload (or its size, when the row count is unknown).
+
+    The estimate self-calibrates on the peak RSS recorded for the last
+    CALIBRATION_SAMPLES runs in the job store: a line fitted through peak
+    RSS against rows, raised by its largest underestimate so it bounds
+    every measured run. Until enough runs of different sizes are known the
+    defaults are used.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def model(self):
+        """(base bytes, bytes per row, upload bytes per row) of the current estimate."""
+        samples = self.store.memory_samples(CALIBRATION_SAMPLES)
+        rows = np.array([sample["rows"] for sample in samples], dtype=float)
+        peaks = np.array([sample["peak_rss_bytes"] for sample in samples], dtype=float)
+        inputs = np.array([sample["input_bytes"] for sample in samples], dtype=float)
+
+        input_per_row = DEFAULT_INPUT_BYTES_PER_ROW
+        if len(samples):
+            input_per_row = float(np.median(inputs / np.maximum(rows, 1)))
+        if len(samples) < MIN_CALIBRATION_SAMPLES or len(np.unique(rows)) < 2:
+            return DEFAULT_BASE_RSS_BYTES, DEFAULT_RSS_PER_ROW, input_per_row
+        per_row, base = np.polyfit(rows, peaks, 1)
+        if per_row <= 0:
+            return DEFAULT_BASE_RSS_BYTES, DEFAULT_RSS_PER_ROW, input_per_row
+        base += max(0.0, float(np.max(peaks - (base + per_row * rows))))
+        return base, per_row, input_per_row
+
+    def estimate(self, path: str) -> int:
+        """Estimated peak RSS in bytes of processing the upload at ``path``."""
+        base, per_row, input_per_row = self.model()
+        rows = upload_rows(path)
+        if rows is None:
+            rows = os.path.getsize(path) / max(input_per_row, 1)
+        return int(base + per_row * rows)
+
+    def record(self, stats):
+        """Add the rows, input bytes and peak RSS of a finished run (its stats)."""
+        if stats.get("rows") and stats.get("peak_rss_bytes"):
+            self.store.add_memory_sample(
+                stats["rows"], stats.get("input_bytes") or 0, stats["peak_rss_bytes"]
+            )
+
+
+def upload_rows(path: str) -> Optional[int]:
+    try:
+        return count_rows(path)
+    except Exception:
+        # Unreadable uploads fail in the pipeline with a proper message
+        return None
@@ -0,0 +1,290 @@
+"""
+Batch processing of several Bron.xlsx exports (e.g. one per club or region)
+into one zip with a Modified_*.xlsx per workbook and a manifest.json with
+the status of every file. A failing workbook is listed in the manifest and
+does not stop the others.
+
+    python -m app.batch noord.xlsx zuid.xlsx -o Modified_batch.zip
+    python -m app.batch exports.zip --workers 2
+"""
+
+import argparse
+import json
+import os
+import posixpath
+import shutil
+import sys
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from app.cache import cache_hasher
+from app.jobs import JOB_WORKERS, run_pipeline
+from app.uploads import MAX_UPLOAD_BYTES, remove_upload, upload_dir
+
+# Most workbooks accepted in one batch, counting the .xlsx files in zips
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", "50"))
+# Largest /batch request, all its files together; each file is still held
+# to MAX_UPLOAD_BYTES
+MAX_BATCH_BYTES = int(
+    os.environ.get("MAX_BATCH_BYTES", str(MAX_BATCH_FILES * MAX_UPLOAD_BYTES))
+)
+
+BATCH_SUFFIXES = (".xlsx", ".zip")
+BATCH_FILENAME = "Modified_batch.zip"
+MANIFEST_NAME = "manifest.json"
+EXTRACT_CHUNK_BYTES = 1024 * 1024
+
+
+class BatchTooLarge(ValueError):
+    pass
+
+
+@dataclass
+class BatchItem:
+    """One workbook of a batch, with its input file and outcome."""
+
+    filename: str
+    path: Optional[str] = None
+    key: Optional[str] = None
+    status: str = "queued"
+    error: Optional[str] = None
+    cached: bool = False
+    output: Optional[str] = None
+    # Where the finished result is kept: its name in the job store (the
+    # endpoint) or a file (the CLI); read one at a time by write_batch
+    result: Optional[str] = field(default=None, repr=False)
+
+    def to_dict(self) -> Dict:
+        return {
+            "file": self.filename,
+            "output": self.output if self.status == "done" else None,
+            "status": self.status,
+            "error": self.error,
+            "cached": self.cached,
+        }
+
+
+def _extract_member(archive, member, directory):
+    """Copy a zip member into ``directory``, hashing it; returns (path, key)."""
+    hasher = cache_hasher()
+    with archive.open(member) as source, tempfile.NamedTemporaryFile(
+        dir=directory, prefix="batch-", suffix=".xlsx", delete=False
+    ) as target:
+        try:
+            while chunk := source.read(EXTRACT_CHUNK_BYTES):
+                hasher.update(chunk)
+                target.write(chunk)
+        except BaseException:
+            target.close()
+            remove_upload(target.name)
+            raise
+    return target.name, hasher.hexdigest()
+
+
+def _unpack(filename, path, directory, limit) -> List[BatchItem]:
+    """The items of the zip upload at ``path``, extracting at most ``limit`` workbooks."""
+    items = []
+    try:
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                name = member.filename
+                if member.is_dir() or name.startswith("__MACOSX/"):
+                    continue
+                base = posixpath.basename(name)
+                if not base.lower().endswith(".xlsx") or base.startswith("~$"):
+                    items.append(
+                        BatchItem(name, status="skipped", error="Not an .xlsx file")
+                    )
+                elif member.file_size > MAX_UPLOAD_BYTES:
+                    items.append(
+                        BatchItem(
+                            name,
+                            status="failed",
+                            error=f"File exceeds the limit of {MAX_UPLOAD_BYTES} bytes",
+                        )
+                    )
+                else:
+                    if sum(item.path is not None for item in items) >= limit:
+                        raise BatchTooLarge(
+                            f"A batch holds at most {MAX_BATCH_FILES} workbooks"
+                        )
+                    try:
+                        member_path, key = _extract_member(archive, member, directory)
+                    except (zipfile.BadZipFile, OSError, RuntimeError) as e:
+                        items.append(BatchItem(name, status="failed", error=str(e)))
+                    else:
+                        items.append(BatchItem(name, member_path, key))
+    except (zipfile.BadZipFile, OSError) as e:
+        items.append(BatchItem(filename, status="failed", error=f"Unreadable zip: {e}"))
+    except BaseException:
+        for item in items:
+            remove_upload(item.path)
+        raise
+    return items
+
+
+def collect_batch(
+    uploads: Sequence[Union[Tuple[str, str, Optional[str]], BatchItem]],
+    directory: Optional[str] = None,
+) -> List[BatchItem]:
+    """
+    The workbooks of a batch of (filename, path, cache key) uploads: .xlsx
+    files as they are, zips by their .xlsx members, which are extracted into
+    ``directory`` (default UPLOAD_DIR). Other files and unreadable zips are
+    kept as skipped or failed items, as are the BatchItems of uploads that
+    were already refused (e.g. an empty file). Output names are assigned.
+
+    Raises BatchTooLarge beyond MAX_BATCH_FILES workbooks, after removing
+    the files extracted so far; the uploads themselves are left in place.
+    """
+    if directory is None:
+        directory = upload_dir()
+    items: List[BatchItem] = []
+    spooled = [upload for upload in uploads if not isinstance(upload, BatchItem)]
+    try:
+        for upload in uploads:
+            if isinstance(upload, BatchItem):
+                items.append(upload)
+                continue
+            filename, path, key = upload
+            suffix = os.path.splitext(filename)[1].lower()
+            if suffix == ".zip":
+                limit = MAX_BATCH_FILES - sum(item.path is not None for item in items)
+                items.extend(_unpack(filename, path, directory, limit))
+            elif suffix == ".xlsx":
+                items.append(BatchItem(filename, path, key))
+            else:
+                items.append(
+                    BatchItem(
+                        filename,
+                        status="failed",
+                        error=f"Only {' and '.join(BATCH_SUFFIXES)} files are supported",
+                    )
+                )
+            if sum(item.path is not None for item in items) > MAX_BATCH_FILES:
+                raise BatchTooLarge(f"A batch holds at most {MAX_BATCH_FILES} workbooks")
+    except BaseException:
+        uploaded = {path for _, path, _ in spooled}
+        for item in items:
+            if item.path not in uploaded:
+                remove_upload(item.path)
+        raise
+    assign_outputs(items)
+    return items
+
+
+def assign_outputs(items: Sequence[BatchItem]):
+    """Give every workbook a unique Modified_<name>.xlsx name in the result zip."""
+    taken = set()
+    for item in items:
+        if item.path is None:
+            continue
+        stem = os.path.splitext(posixpath.basename(item.filename.replace("\\", "/")))[0]
+        output, number = f"Modified_{stem}.xlsx", 1
+        while output.lower() in taken:
+            number += 1
+            output = f"Modified_{stem} ({number}).xlsx"
+        taken.add(output.lower())
+        item.output = output
+
+
+def write_batch(
+    items: Sequence[BatchItem], target, read_result: Callable[[str], Optional[bytes]]
+):
+    """
+    Write the results of the finished ``items`` and manifest.json to the
+    zip ``target``. ``read_result`` loads the result of an item (see
+    BatchItem.result), so only one is held in memory at a time; a result
+    that is gone is reported as failed. The workbooks are already
+    compressed and stored as is.
+    """
+    with zipfile.ZipFile(target, "w", zipfile.ZIP_STORED) as archive:
+        for item in items:
+            if item.status != "done":
+                continue
+            result = read_result(item.result)
+            if result is None:
+                item.status, item.error = "failed", "The result has expired"
+                continue
+            archive.writestr(item.output, result)
+            # Released before the next one is read
+            del result
+        manifest = {
+            "files": [item.to_dict() for item in items],
+            "done": sum(item.status == "done" for item in items),
+            "failed": sum(item.status == "failed" for item in items),
+            "skipped": sum(item.status == "skipped" for item in items),
+        }
+        archive.writestr(
+            MANIFEST_NAME,
+            json.dumps(manifest, indent=2, ensure_ascii=False),
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+    return manifest
+
+
+def run_batch(items: Sequence[BatchItem], workers: int, directory: str):
+    """
+    Process the workbooks of ``items`` on ``workers`` processes, filling in
+    their outcome. Results are written to files in ``directory``.
+    """
+    pending = [item for item in items if item.path is not None]
+    if not pending:
+        return
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(workers, len(pending))), mp_context=get_context("spawn")
+    ) as pool:
+        futures = {pool.submit(run_pipeline, item.path): item for item in pending}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                result, _ = future.result()
+            except Exception as e:
+                item.status, item.error = "failed", str(e)
+            else:
+                with tempfile.NamedTemporaryFile(
+                    dir=directory, prefix="result-", suffix=".xlsx", delete=False
+                ) as output:
+                    output.write(result)
+                item.result, item.status = output.name, "done"
+            print(f"{item.status:>6}  {item.filename}", file=sys.stderr)
+
+
+def _read_file(path):
+    with open(path, "rb") as result:
+        return result.read()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process several Bron.xlsx exports into one zip")
+    parser.add_argument("inputs", nargs="+", help=".xlsx files and/or zips of them")
+    parser.add_argument("-o", "--output", default=BATCH_FILENAME)
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS)
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix="batch-")
+    try:
+        uploads = [(os.path.basename(path), path, None) for path in args.inputs]
+        try:
+            items = collect_batch(uploads, scratch)
+        except BatchTooLarge as e:
+            parser.error(str(e))
+        run_batch(items, args.workers, scratch)
+        with open(args.output, "wb") as output:
+            manifest = write_batch(items, output, _read_file)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    print(
+        f"{manifest['done']} done, {manifest['failed']} failed, "
+        f"{manifest['skipped']} skipped -> {args.output}",
+        file=sys.stderr,
+    )
+    return 1 if manifest["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import excel_processor
+
+# Total size of the processed workbooks kept for repeated uploads
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", str(128 * 1024 * 1024)))
+
+
+def cache_hasher():
+    """
+    SHA-256 hasher for the content address of an upload, seeded with the
+    pipeline version and the settings that change the output. Feed it the
+    upload bytes and use hexdigest() as the cache key.
+    """
+    return hashlib.sha256(
+        f"{excel_processor.PIPELINE_VERSION}:{excel_processor.MAX_FAMILY_SLOTS}:"
+        f"{excel_processor.DTYPE_MODE}\0".encode()
+    )
+
+
+def result_key(key: str, output_format: str = "xlsx", sheets=None) -> str:
+    """
+    Cache key of the ``output_format`` result, limited to ``sheets`` when
+    given, of the upload with ``key``. The full workbook uses ``key`` itself.
+    """
+    if output_format != "xlsx":
+        key = f"{key}.{output_format}"
+    if sheets is not None:
+        key = f"{key}:{'|'.join(sheets)}"
+    return key
+
+
+class ResultCache:
+    """
+    LRU cache of processed workbooks keyed by upload digest, evicting the least
+    recently used results once their total size exceeds ``max_bytes``. It
+    sits in front of the results in the job store, so its hit and miss
+    counters are recorded per lookup of a result in either (see
+    JobManager.find_result); ``memory_hits`` counts the reads served from
+    memory.
+    """
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                return None
+            self._entries.move_to_end(key)
+            self.memory_hits += 1
+            return value
+
+    def record_lookup(self, found: bool):
+        """Count a lookup of a result: kept (in memory or the job store) or to be produced."""
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,125 @@
+import hashlib
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def attachment_header(filename):
+    return f"attachment; filename*=UTF-8''{quote(filename)}"
+
+
+def result_etag(data) -> str:
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single "bytes=start-end" Range header into an inclusive
+    (start, end) pair. Returns None when the header is absent, invalid
+    (including an end before the start) or asks for several ranges, in which
+    case the whole body is served. Raises RangeNotSatisfiable for a range
+    starting beyond the body.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].strip()
+    if "," in spec:
+        return None
+    start_text, _, end_text = spec.partition("-")
+    try:
+        if start_text == "":
+            suffix = int(end_text)
+            if suffix <= 0 or size == 0:
+                raise RangeNotSatisfiable(header)
+            return max(0, size - suffix), size - 1
+        start = int(start_text)
+        end = int(end_text) if end_text else None
+    except RangeNotSatisfiable:
+        raise
+    except ValueError:
+        return None
+    if end is not None and end < start:
+        # RFC 9110: an invalid range is ignored
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or any(
+        candidate.removeprefix("W/") == etag for candidate in candidates
+    )
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """A 304 response when the If-None-Match header of ``request`` matches ``etag``."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+def _chunks(view):
+    for offset in range(0, len(view), DOWNLOAD_CHUNK_BYTES):
+        yield view[offset:offset + DOWNLOAD_CHUNK_BYTES]
+
+
+def file_chunks(file):
+    """Yield ``file`` from its start in chunks and close it afterwards."""
+    try:
+        file.seek(0)
+        while chunk := file.read(DOWNLOAD_CHUNK_BYTES):
+            yield chunk
+    finally:
+        file.close()
+
+
+def serve_result(request: Request, data, filename: str, etag: str, media_type: str):
+    """
+    Stream a stored result in chunks of a memoryview, so the result is never
+    copied, with Content-Length and ETag headers. Answers If-None-Match with
+    304 and a single byte range (honouring If-Range) with 206, so an
+    interrupted download can resume.
+    """
+    view = memoryview(data)
+    size = len(view)
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": attachment_header(filename),
+    }
+
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if if_range is None or if_range.strip() == etag:
+        try:
+            byte_range = parse_range(request.headers.get("range"), size)
+        except RangeNotSatisfiable:
+            return Response(
+                status_code=416, headers={"Content-Range": f"bytes */{size}", "ETag": etag}
+            )
+
+    status_code = 200
+    if byte_range is not None:
+        start, end = byte_range
+        view = view[start:end + 1]
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(len(view))
+    return StreamingResponse(
+        _chunks(view), status_code=status_code, media_type=media_type, headers=headers
+    )
@@ -0,0 +1,420 @@
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from multiprocessing import get_context
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from excel_processor import process_excel_spooled
+
+from app import metrics
+from app.admission import ADMISSION_QUEUE_LIMIT, MEMORY_BUDGET_BYTES, MemoryEstimator
+from app.cache import ResultCache, result_key
+from app.downloads import result_etag
+from app.store import JobStore
+from app.uploads import remove_upload
+
+# Worker processes running the pandas pipeline in parallel
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Finished jobs and their results are dropped after this many seconds
+JOB_TTL_SECONDS = float(os.environ.get("JOB_TTL_SECONDS", "3600"))
+# How often a server process running jobs reports that it is alive
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", "10"))
+# How often jobs waiting for memory check whether they fit the budget
+ADMISSION_POLL_SECONDS = 1.0
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _job_progress(job_id: str, store: JobStore):
+    """Progress callback recording the progress of ``job_id`` in the job store."""
+    progress: Dict[str, Any] = {}
+
+    def report(stage, **info):
+        # Checked between stages, so a cancelled job stops at the next one
+        if store.cancel_requested(job_id):
+            raise JobCancelled("Cancelled")
+        progress.update(info, stage=stage)
+        store.update_job(job_id, progress=progress)
+
+    return report
+
+
+def run_pipeline(
+    path: str,
+    output_format: str = "xlsx",
+    sheets: Optional[Tuple[str, ...]] = None,
+    job_id: Optional[str] = None,
+    store: Optional[JobStore] = None,
+) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Process the upload at ``path`` and return the result bytes (see
+    process_excel_spooled for ``output_format`` and ``sheets``) with the run's stats:
+    seconds per stage, rows, input and output bytes and the peak RSS of the
+    process that ran it. For a job in ``store``, the job is marked running,
+    its progress recorded and it can be cancelled between stages.
+    """
+    metrics.reset_peak_rss()
+    stats: Dict[str, Any] = {}
+    progress = None
+    if job_id is not None and store is not None:
+        store.start_job(job_id)
+        progress = _job_progress(job_id, store)
+    with process_excel_spooled(path, stats, output_format, sheets, progress) as output:
+        result = output.read()
+    stats["peak_rss_bytes"] = metrics.peak_rss_bytes()
+    return result, stats
+
+
+def run_job(
+    path: str,
+    output_format: str,
+    sheets: Optional[Tuple[str, ...]],
+    job_id: str,
+    store: JobStore,
+    result_name: str,
+) -> Dict[str, Any]:
+    """
+    Run a job on a pool worker (see run_pipeline) and store its result as
+    ``result_name`` from the worker itself, so only the stats (with the
+    result's ETag) travel back to the server process.
+    """
+    result, stats = run_pipeline(path, output_format, sheets, job_id, store)
+    stats["etag"] = result_etag(result)
+    try:
+        store.put_result(result_name, result, stats["etag"])
+    except OSError as e:
+        raise OSError(f"Storing the result failed: {e}") from e
+    return stats
+
+
+@dataclass
+class Job:
+    id: str
+    filename: str
+    created_at: float
+    status: str = "queued"
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    cached: bool = False
+    output_format: str = "xlsx"
+    sheets: Optional[Tuple[str, ...]] = None
+    progress: Dict[str, Any] = field(default_factory=dict)
+    key: Optional[str] = field(default=None, repr=False)
+    upload_path: Optional[str] = field(default=None, repr=False)
+    # Name of the result in the job store and result cache
+    result_name: Optional[str] = field(default=None, repr=False)
+    etag: Optional[str] = field(default=None, repr=False)
+    owner: Optional[str] = field(default=None, repr=False)
+    cancel_requested: bool = field(default=False, repr=False)
+    memory_estimate: Optional[int] = field(default=None, repr=False)
+    peak_rss_bytes: Optional[int] = field(default=None, repr=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "cached": self.cached,
+            "format": self.output_format,
+            "sheets": list(self.sheets) if self.sheets is not None else None,
+            "progress": self.progress,
+            "memory_estimate_bytes": self.memory_estimate,
+            "peak_rss_bytes": self.peak_rss_bytes,
+        }
+
+
+class JobManager:
+    """
+    Runs spooled uploads through the pipeline on a bounded process pool, so
+    several uploads can be processed at once without sharing state. Workers
+    read the upload file and store the result themselves; the upload is
+    removed once the job finishes.
+
+    Jobs and results live in a JobStore, so every server process can report
+    on, cancel and serve the jobs of the others. Workers record progress
+    there and check it for cancel requests between stages. Processes with
+    running jobs send heartbeats; the jobs of a process that stopped
+    (e.g. a restart) are failed by the next prune.
+
+    A job only starts when its estimated peak memory fits the memory budget
+    next to the jobs already running in any server process (see
+    app.admission); until then it waits, in order, in this process. The
+    peak RSS of every run on the pool is fed back to the estimate.
+    """
+
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        ttl: float = JOB_TTL_SECONDS,
+        cache: Optional[ResultCache] = None,
+        store: Optional[JobStore] = None,
+        budget: int = MEMORY_BUDGET_BYTES,
+    ):
+        self.workers = workers
+        self.ttl = ttl
+        self.cache = cache
+        self.store = store if store is not None else JobStore()
+        self.budget = budget
+        self.estimator = MemoryEstimator(self.store)
+        self.owner = uuid.uuid4().hex
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._futures: Dict[str, Any] = {}
+        self._waiting: Deque[Job] = deque()
+        self._reserved: Dict[str, int] = {}
+        self._stopped = threading.Event()
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+        # Reentrant: a job that finished at once is closed within _dispatch
+        self._dispatch_lock = threading.RLock()
+
+    def start(self):
+        with self._lock:
+            if self._executor is None:
+                self.store.heartbeat(self.owner)
+                # spawn: forking a process that runs uvicorn's threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=get_context("spawn")
+                )
+                self._stopped.clear()
+                threading.Thread(target=self._heartbeat, daemon=True).start()
+        return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        self._stopped.set()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _heartbeat(self):
+        beat = time.monotonic()
+        while not self._stopped.wait(ADMISSION_POLL_SECONDS):
+            if time.monotonic() - beat >= JOB_HEARTBEAT_SECONDS:
+                self.store.heartbeat(self.owner)
+                beat = time.monotonic()
+            # Memory may have been released by another server process
+            self._dispatch()
+
+    def queue_room(self) -> int:
+        """How many more jobs of this process may wait for memory (see ADMISSION_QUEUE_LIMIT)."""
+        with self._lock:
+            return max(0, ADMISSION_QUEUE_LIMIT - len(self._waiting))
+
+    def queue_full(self) -> bool:
+        return self.queue_room() == 0
+
+    def reserve(self, reservation: str, size: int) -> bool:
+        """
+        Reserve ``size`` bytes of the memory budget under the id
+        ``reservation``; False when it does not fit next to the current
+        reservations. Release it with release().
+        """
+        if self.budget <= 0:
+            return True
+        # The reservation only counts while this process sends heartbeats
+        self.start()
+        if not self.store.reserve(
+            reservation, self.owner, size, self.budget, JOB_HEARTBEAT_SECONDS
+        ):
+            return False
+        with self._lock:
+            self._reserved[reservation] = size
+            metrics.memory_reserved.set(sum(self._reserved.values()))
+        return True
+
+    def release(self, reservation: str):
+        with self._lock:
+            if self._reserved.pop(reservation, None) is None:
+                return
+            metrics.memory_reserved.set(sum(self._reserved.values()))
+        self.store.release(reservation)
+
+    def submit(
+        self,
+        upload_path: str,
+        filename: str,
+        key: Optional[str] = None,
+        output_format: str = "xlsx",
+        sheets: Optional[Tuple[str, ...]] = None,
+    ) -> Job:
+        self.prune()
+        job = Job(
+            id=uuid.uuid4().hex,
+            filename=filename,
+            created_at=time.time(),
+            output_format=output_format,
+            sheets=sheets,
+            key=key if key is None else result_key(key, output_format, sheets),
+            upload_path=upload_path,
+        )
+        job.result_name = job.key or job.id
+        etag = self.find_result(job.result_name) if job.key is not None else None
+        if etag is not None:
+            job.etag = etag
+            job.status, job.cached, job.finished_at = "done", True, time.time()
+            self.store.create_job(asdict(job))
+            metrics.jobs_total.inc(1, "cached")
+            remove_upload(upload_path)
+            return job
+        self.start()
+        job.owner = self.owner
+        job.memory_estimate = self.estimator.estimate(upload_path)
+        self.store.create_job(asdict(job))
+        metrics.jobs_in_flight.inc()
+        with self._lock:
+            self._waiting.append(job)
+            metrics.jobs_waiting.set(len(self._waiting))
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        """Start the waiting jobs, in order, as long as they fit the memory budget."""
+        with self._dispatch_lock:
+            with self._lock:
+                waiting = list(self._waiting)
+            # Cancel requests may come from another server process
+            for job in waiting:
+                if self.store.cancel_requested(job.id) and self._unqueue(job):
+                    self._close(job, status="cancelled", error="Cancelled")
+            while True:
+                with self._lock:
+                    if not self._waiting:
+                        return
+                    job = self._waiting[0]
+                if not self.reserve(job.id, job.memory_estimate or 0):
+                    return
+                with self._lock:
+                    if self._executor is None or not self._waiting or self._waiting[0] is not job:
+                        # Shut down or cancelled in the meantime
+                        started = False
+                    else:
+                        self._waiting.popleft()
+                        metrics.jobs_waiting.set(len(self._waiting))
+                        future = self._executor.submit(
+                            run_job,
+                            job.upload_path,
+                            job.output_format,
+                            job.sheets,
+                            job.id,
+                            self.store,
+                            job.result_name,
+                        )
+                        self._futures[job.id] = future
+                        started = True
+                if not started:
+                    self.release(job.id)
+                    continue
+                future.add_done_callback(lambda future, job=job: self._finish(job, future))
+
+    def _unqueue(self, job: Job) -> bool:
+        """Take ``job`` out of the waiting jobs; False when it is no longer waiting."""
+        with self._lock:
+            if job not in self._waiting:
+                return False
+            self._waiting.remove(job)
+            metrics.jobs_waiting.set(len(self._waiting))
+        return True
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a queued or running job of any server process. Returns False
+        when the job has already finished; a running job stops at its next
+        stage.
+        """
+        if not self.store.request_cancel(job_id):
+            return False
+        with self._lock:
+            future = self._futures.get(job_id)
+            waiting = next((job for job in self._waiting if job.id == job_id), None)
+        if waiting is not None and self._unqueue(waiting):
+            self._close(waiting, status="cancelled", error="Cancelled")
+        elif future is not None:
+            future.cancel()
+        return True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.prune()
+        row = self.store.get_job(job_id)
+        return Job(**row) if row is not None else None
+
+    def find_result(self, name: str) -> Optional[str]:
+        """
+        The ETag of the kept result ``name``, counted as a cache hit; None,
+        counted as a miss, when it has to be produced.
+        """
+        etag = self.store.result_etag(name)
+        if self.cache is not None:
+            self.cache.record_lookup(etag is not None)
+        return etag
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """The result cache stats with the size of the results in the job store."""
+        stats = self.cache.stats() if self.cache is not None else {}
+        stats.update(
+            store_bytes=self.store.results_bytes(), store_max_bytes=self.store.max_result_bytes
+        )
+        return stats
+
+    def load_result(self, name: str) -> Optional[bytes]:
+        """The result ``name`` from the result cache or the job store, if kept."""
+        if self.cache is not None:
+            result = self.cache.get(name)
+            if result is not None:
+                return result
+        result = self.store.read_result(name)
+        if result is not None and self.cache is not None:
+            self.cache.put(name, result)
+        return result
+
+    def save_result(self, name: str, result: bytes, etag: str):
+        self.store.put_result(name, result, etag)
+        if self.cache is not None:
+            self.cache.put(name, result)
+
+    def prune(self):
+        # At most once per heartbeat interval per process
+        now = time.time()
+        if now - self._pruned_at < JOB_HEARTBEAT_SECONDS:
+            return
+        self._pruned_at = now
+        for upload_path in self.store.prune(self.ttl, JOB_HEARTBEAT_SECONDS):
+            remove_upload(upload_path)
+
+    def _finish(self, job: Job, future):
+        fields: Dict[str, Any] = {}
+        if future.cancelled() or isinstance(future.exception(), JobCancelled):
+            fields.update(status="cancelled", error="Cancelled")
+        elif future.exception() is not None:
+            fields.update(status="failed", error=str(future.exception()))
+        else:
+            # The worker has stored the result (see run_job)
+            stats = future.result()
+            fields.update(status="done", etag=stats["etag"])
+            metrics.record_run(stats)
+            fields["peak_rss_bytes"] = stats.get("peak_rss_bytes")
+            self.estimator.record(stats)
+        self.release(job.id)
+        with self._lock:
+            self._futures.pop(job.id, None)
+        self._close(job, **fields)
+        # Memory was released for the next waiting job
+        if not self._stopped.is_set():
+            self._dispatch()
+
+    def _close(self, job: Job, **fields):
+        fields["finished_at"] = time.time()
+        self.store.finish_job(job.id, **fields)
+        metrics.jobs_in_flight.dec()
+        metrics.jobs_total.inc(1, fields["status"])
+        remove_upload(job.upload_path)
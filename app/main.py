@@ -1,27 +1,189 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
-from starlette.background import BackgroundTask
-from typing import Optional
-from io import BytesIO
+import asyncio
+import json
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from typing import List, Optional, Tuple
+import time
+import uuid
 
-# Import bytes-based processor
-from excel_processor import process_excel_bytes
+from app import metrics
+from app.admission import ADMISSION_RETRY_SECONDS
+from app.batch import (
+    BATCH_FILENAME,
+    BATCH_SUFFIXES,
+    MAX_BATCH_BYTES,
+    BatchItem,
+    BatchTooLarge,
+    collect_batch,
+    write_batch,
+)
+from app.cache import ResultCache, result_key
+from app.downloads import (
+    attachment_header,
+    file_chunks,
+    not_modified,
+    result_etag,
+    serve_result,
+)
+from app.jobs import FINISHED_STATUSES, JOB_TTL_SECONDS, JobManager, run_pipeline
+from app.uploads import MAX_UPLOAD_BYTES, remove_upload, spool_upload
+from excel_processor import (
+    SPOOL_MAX_BYTES,
+    available_output_formats,
+    check_source,
+    select_sheets,
+)
 
-app = FastAPI(title="Media Point Excel Processor")
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+ZIP_MEDIA_TYPE = "application/zip"
+# Allowance for the multipart framing around the uploaded file
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+# How often /jobs/{id}/events checks a job for new progress
+PROGRESS_POLL_SECONDS = 0.25
 
-# In-memory buffers and simple timestamps
-UPLOAD_BUFFER: Optional[bytes] = None
-OUTPUT_BUFFER: Optional[bytes] = None
-UPLOADED_AT: Optional[float] = None
-PROCESSED_AT: Optional[float] = None
+results_cache = ResultCache()
+jobs = JobManager(cache=results_cache)
 
 
-def cleanup_memory():
-    global UPLOAD_BUFFER, OUTPUT_BUFFER, UPLOADED_AT, PROCESSED_AT
-    UPLOAD_BUFFER = None
-    OUTPUT_BUFFER = None
-    UPLOADED_AT = None
-    PROCESSED_AT = None
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    jobs.shutdown()
+
+
+app = FastAPI(title="Media Point Excel Processor", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def reject_oversized_uploads(request, call_next):
+    # Refuse based on Content-Length before any of the body is read; a
+    # batch carries several files, each checked against MAX_UPLOAD_BYTES
+    length = request.headers.get("content-length")
+    limit = MAX_BATCH_BYTES if request.url.path == "/batch" else MAX_UPLOAD_BYTES
+    if (
+        request.method == "POST"
+        and length is not None
+        and length.isdigit()
+        and int(length) > limit + MULTIPART_OVERHEAD_BYTES
+    ):
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"Upload exceeds the limit of {limit} bytes"},
+        )
+    return await call_next(request)
+
+
+def check_output_format(output_format: str):
+    if output_format not in available_output_formats():
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported format; choose one of {', '.join(available_output_formats())}",
+        )
+
+
+def parse_sheets(sheets: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """The comma separated sheet names of a ``sheets`` parameter; None for all sheets."""
+    if not sheets:
+        return None
+    names = tuple(name.strip() for name in sheets.split(",") if name.strip())
+    try:
+        return tuple(spec.name for spec in select_sheets(names))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def result_file(filename: str, output_format: str):
+    """Download name and media type of the ``output_format`` result of ``filename``."""
+    if output_format == "xlsx":
+        return f"Modified_{filename}", XLSX_MEDIA_TYPE
+    stem = os.path.splitext(filename)[0]
+    return f"Modified_{stem}.{output_format}.zip", ZIP_MEDIA_TYPE
+
+
+def busy(status_code: int, detail: str) -> HTTPException:
+    metrics.admission_rejected.inc(1, str(status_code))
+    return HTTPException(
+        status_code=status_code,
+        detail=detail,
+        headers={"Retry-After": str(ADMISSION_RETRY_SECONDS)},
+    )
+
+
+def check_queue():
+    if jobs.queue_full():
+        raise busy(429, "Too many jobs are waiting; try again later")
+
+
+async def check_upload(path: str):
+    """Refuse an upload that is not a Bron.xlsx export before any worker sees it."""
+    try:
+        await asyncio.to_thread(check_source, path)
+    except ValueError as e:
+        remove_upload(path)
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def check_batch(items):
+    """Mark the workbooks of a batch that are not Bron.xlsx exports as failed."""
+    for item in items:
+        if item.path is None:
+            continue
+        try:
+            check_source(item.path)
+        except ValueError as e:
+            remove_upload(item.path)
+            item.path, item.status, item.error = None, "failed", str(e)
+
+
+def process_upload(
+    upload, output_format: str, sheets: Optional[Tuple[str, ...]] = None
+) -> Tuple[bytes, str]:
+    """
+    Run the current ``upload`` (see JobStore.get_upload) for the
+    ``output_format`` result limited to ``sheets``; stores the result and
+    returns it with its ETag. The run needs room in the memory budget;
+    there is no queue here.
+    """
+    reservation = uuid.uuid4().hex
+    if not jobs.reserve(reservation, jobs.estimator.estimate(upload["path"])):
+        raise busy(503, "Not enough memory to process the file now; try again later")
+    metrics.jobs_in_flight.inc()
+    try:
+        output_bytes, stats = run_pipeline(upload["path"], output_format, sheets)
+    except Exception as e:
+        metrics.jobs_total.inc(1, "failed")
+        raise HTTPException(status_code=500, detail=f"Processing failed: {e}")
+    finally:
+        metrics.jobs_in_flight.dec()
+        jobs.release(reservation)
+    metrics.record_run(stats)
+    # No memory sample: the peak RSS of the server process includes the
+    # result cache and the other requests, so only pool runs calibrate
+    metrics.jobs_total.inc(1, "done")
+    etag = result_etag(output_bytes)
+    jobs.save_result(result_key(upload["key"], output_format, sheets), output_bytes, etag)
+    return output_bytes, etag
+
+
+def current_upload():
+    """
+    The current upload of the /upload, /run and /download flow, shared by
+    all server processes through the job store; None when there is none.
+    The upload and its result are kept for JOB_TTL_SECONDS after the last
+    upload or run, so downloads can be repeated or resumed until then.
+    """
+    upload = jobs.store.get_upload()
+    if upload is None:
+        return None
+    last_used = max(upload["uploaded_at"], upload["processed_at"] or 0)
+    if time.time() - last_used > JOB_TTL_SECONDS:
+        if jobs.store.clear_upload(upload["path"]):
+            remove_upload(upload["path"])
+        return None
+    return upload
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -51,6 +213,7 @@ def read_root():
       <input id="fileInput" type="file" name="file" accept=".xlsx" required />
       <button id="uploadBtn" type="submit">Upload Bron.xlsx</button>
       <div id="status" class="muted"></div>
+      <button id="cancelBtn" class="hidden" type="button">Cancel</button>
     </form>
 
     <button id="downloadBtn" class="hidden">Download Modified_Bron.xlsx</button>
@@ -61,6 +224,7 @@ def read_root():
       const uploadBtn = document.getElementById('uploadBtn');
       const statusBox = document.getElementById('status');
       const downloadBtn = document.getElementById('downloadBtn');
+      const cancelBtn = document.getElementById('cancelBtn');
 
       function toggleDownload(show) {
         if (show) {
@@ -70,12 +234,50 @@ def read_root():
         }
       }
 
+      let jobId = sessionStorage.getItem('jobId');
+
+      function describe(job) {
+        const progress = job.progress || {};
+        if (job.status === 'queued' && !progress.stage) return 'Waiting in queue...';
+        if (!progress.stage || progress.stage === 'read') return 'Reading file...';
+        if (progress.stage === 'write') {
+          const written = progress.written ? `, ${progress.written.toLocaleString()} rows` : '';
+          return `Writing sheet ${progress.sheet} of ${progress.sheets} (${progress.name}${written})...`;
+        }
+        const rows = progress.rows ? `, ${progress.rows.toLocaleString()} rows` : '';
+        return `Processing (${progress.stage}${rows})...`;
+      }
+
+      function waitForJob(id) {
+        // Progress arrives as server-sent events until the job finishes
+        return new Promise((resolve, reject) => {
+          const source = new EventSource(`/jobs/${id}/events`);
+          source.onmessage = (event) => {
+            const job = JSON.parse(event.data);
+            if (job.status === 'done') {
+              source.close();
+              resolve();
+            } else if (job.status === 'failed' || job.status === 'cancelled') {
+              source.close();
+              reject(new Error(job.status === 'cancelled' ? 'Cancelled' : (job.error || 'Run failed')));
+            } else {
+              statusBox.textContent = describe(job);
+            }
+          };
+          source.onerror = () => {
+            source.close();
+            reject(new Error('Lost connection to the server'));
+          };
+        });
+      }
+
       async function refreshState() {
+        if (!jobId) return;
         try {
-          const res = await fetch('/status');
+          const res = await fetch(`/jobs/${jobId}`);
           if (!res.ok) return;
           const data = await res.json();
-          toggleDownload(data.processed);
+          toggleDownload(data.status === 'done');
         } catch (e) { /* ignore */ }
       }
 
@@ -84,46 +286,44 @@ def read_root():
         if (!fileInput.files.length) return;
         statusBox.textContent = 'Uploading...';
         uploadBtn.disabled = true;
+        toggleDownload(false);
         const formData = new FormData();
         formData.append('file', fileInput.files[0]);
         try {
-          const res = await fetch('/upload', { method: 'POST', body: formData });
+          const res = await fetch('/jobs', { method: 'POST', body: formData });
+          const data = await res.json().catch(() => ({}));
           if (!res.ok) {
-            const msg = await res.text();
-            throw new Error(msg || 'Upload failed');
+            throw new Error(data.detail || 'Upload failed');
           }
+          jobId = data.id;
+          sessionStorage.setItem('jobId', jobId);
           statusBox.textContent = 'Processing...';
-          toggleDownload(false);
-          const runRes = await fetch('/run', { method: 'POST' });
-          const runData = await runRes.json().catch(() => ({}));
-          if (!runRes.ok) {
-            const msg = runData && runData.message ? runData.message : 'Run failed';
-            throw new Error(msg);
-          }
+          cancelBtn.classList.remove('hidden');
+          await waitForJob(jobId);
           statusBox.textContent = 'Download is ready.';
           toggleDownload(true);
         } catch (err) {
           statusBox.textContent = `Error: ${err.message}`;
         } finally {
           uploadBtn.disabled = false;
+          cancelBtn.classList.add('hidden');
         }
       });
 
-      downloadBtn.addEventListener('click', async () => {
-        try {
-          const res = await fetch('/status');
-          const data = await res.json();
-          if (!data.processed) {
-            return;
-          }
-          window.location.href = '/download';
-          setTimeout(() => {
-            toggleDownload(false);
-            statusBox.textContent = '';
-          }, 750);
-        } catch (_) {
-          statusBox.textContent = 'Unable to download right now.';
-        }
+      cancelBtn.addEventListener('click', async () => {
+        if (!jobId) return;
+        cancelBtn.classList.add('hidden');
+        statusBox.textContent = 'Cancelling...';
+        await fetch(`/jobs/${jobId}/cancel`, { method: 'POST' }).catch(() => {});
+      });
+
+      downloadBtn.addEventListener('click', () => {
+        if (!jobId) return;
+        window.location.href = `/jobs/${jobId}/result`;
+        setTimeout(() => {
+          toggleDownload(false);
+          statusBox.textContent = '';
+        }, 750);
       });
 
       document.addEventListener('DOMContentLoaded', refreshState);
@@ -135,58 +335,241 @@ def read_root():
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
-    if not file.filename.lower().endswith(".xlsx"):
-        raise HTTPException(status_code=400, detail="Only .xlsx files are supported")
-    global UPLOAD_BUFFER, OUTPUT_BUFFER, UPLOADED_AT, PROCESSED_AT
-    data = await file.read()
-    if not data:
-        raise HTTPException(status_code=400, detail="Uploaded file is empty")
-    UPLOAD_BUFFER = data
-    UPLOADED_AT = __import__("time").time()
-    # Reset processed state on new upload
-    OUTPUT_BUFFER = None
-    PROCESSED_AT = None
+    path, key = await spool_upload(file)
+    await check_upload(path)
+    # Replacing the upload also resets the processed state
+    remove_upload(await asyncio.to_thread(jobs.store.set_upload, path, key))
     return JSONResponse({"message": "Upload successful"})
 
 
 @app.post("/run")
 def run_processing():
-    global UPLOAD_BUFFER, OUTPUT_BUFFER, PROCESSED_AT
-    if UPLOAD_BUFFER is None:
+    upload = current_upload()
+    if upload is None:
         raise HTTPException(status_code=400, detail="Please upload Bron.xlsx first.")
-    try:
-        output_bytes = process_excel_bytes(UPLOAD_BUFFER)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Processing failed: {e}")
-    OUTPUT_BUFFER = output_bytes
-    PROCESSED_AT = __import__("time").time()
+    if jobs.find_result(result_key(upload["key"])) is not None:
+        metrics.jobs_total.inc(1, "cached")
+    else:
+        process_upload(upload, "xlsx")
+    jobs.store.mark_processed(upload["path"])
     return JSONResponse(
         status_code=200, content={"message": "File processed successfully."}
     )
 
 
 @app.get("/download")
-def download_output():
-    if OUTPUT_BUFFER is None:
+def download_output(
+    request: Request,
+    output_format: str = Query("xlsx", alias="format"),
+    sheets: Optional[str] = None,
+):
+    check_output_format(output_format)
+    selected = parse_sheets(sheets)
+    upload = current_upload()
+    if upload is None or upload["processed_at"] is None:
         raise HTTPException(
             status_code=404,
             detail="Modified_Bron.xlsx not found. Run the processor first.",
         )
-    background = BackgroundTask(cleanup_memory)
-    return StreamingResponse(
-        BytesIO(OUTPUT_BUFFER),
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=Modified_Bron.xlsx"},
-        background=background,
-    )
+    filename, media_type = result_file("Bron.xlsx", output_format)
+    key = result_key(upload["key"], output_format, selected)
+    output_bytes = None
+    # The ETag is kept with the result, so a revalidation reads nothing
+    etag = jobs.find_result(key)
+    if etag is not None:
+        unchanged = not_modified(request, etag)
+        if unchanged is not None:
+            return unchanged
+        output_bytes = jobs.load_result(key)
+    if output_bytes is None:
+        # Other formats and sheet selections (and a workbook evicted from
+        # the store) are produced from the kept upload on first request
+        output_bytes, etag = process_upload(upload, output_format, selected)
+    return serve_result(request, output_bytes, filename, etag, media_type)
 
 
 @app.get("/status")
 def status():
-    uploaded = UPLOAD_BUFFER is not None
-    processed = (
-        OUTPUT_BUFFER is not None
-        and uploaded
-        and ((PROCESSED_AT or 0) >= (UPLOADED_AT or 0))
+    upload = current_upload()
+    return JSONResponse(
+        {
+            "uploaded": upload is not None,
+            "processed": upload is not None and upload["processed_at"] is not None,
+        }
+    )
+
+
+@app.get("/cache")
+def cache_stats():
+    return JSONResponse(jobs.cache_stats())
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(
+        metrics.render(jobs.cache_stats()), media_type=metrics.CONTENT_TYPE
+    )
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    file: UploadFile = File(...),
+    output_format: str = Query("xlsx", alias="format"),
+    sheets: Optional[str] = None,
+):
+    check_output_format(output_format)
+    selected = parse_sheets(sheets)
+    check_queue()
+    path, key = await spool_upload(file)
+    await check_upload(path)
+    # submit and get use the job store; kept off the event loop
+    job = await asyncio.to_thread(
+        jobs.submit, path, os.path.basename(file.filename), key, output_format, selected
+    )
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JSONResponse(job.to_dict())
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events with the job state each time it changes, until it finishes."""
+    job = await asyncio.to_thread(jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def stream():
+        last, current = None, job
+        while True:
+            # The job is read from the store, where any server process may update it
+            current = await asyncio.to_thread(jobs.get, job_id) or current
+            state = current.to_dict()
+            if state != last:
+                yield f"data: {json.dumps(state)}\n\n"
+                last = state
+            if state["status"] in FINISHED_STATUSES:
+                return
+            await asyncio.sleep(PROGRESS_POLL_SECONDS)
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.post("/jobs/{job_id}/cancel", status_code=202)
+def cancel_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not jobs.cancel(job_id):
+        raise HTTPException(status_code=409, detail="Job has already finished")
+    # A queued job is cancelled at once; report its state after the request
+    job = jobs.get(job_id) or job
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str, request: Request):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=f"Processing failed: {job.error}")
+    if job.status == "cancelled":
+        raise HTTPException(status_code=410, detail="Job was cancelled")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail="Job is still processing")
+    result = jobs.load_result(job.result_name)
+    if result is None:
+        raise HTTPException(status_code=410, detail="The result has expired")
+    filename, media_type = result_file(job.filename, job.output_format)
+    return serve_result(request, result, filename, job.etag, media_type)
+
+
+@app.post("/batch")
+async def process_batch(files: List[UploadFile] = File(...)):
+    """
+    Process several .xlsx uploads and/or zips of them as jobs and answer with
+    a zip of their Modified_*.xlsx results and manifest.json once all are
+    finished. Failing workbooks (and refused files, e.g. an empty one or of
+    another type) are only reported in the manifest; only a file over
+    MAX_UPLOAD_BYTES or a request over MAX_BATCH_BYTES rejects the whole
+    batch.
+    """
+    check_queue()
+    uploads = []
+    try:
+        for file in files:
+            filename = os.path.basename(file.filename or "")
+            try:
+                path, key = await spool_upload(file, BATCH_SUFFIXES)
+            except HTTPException as e:
+                if e.status_code == 413:
+                    raise
+                uploads.append(BatchItem(filename, status="failed", error=e.detail))
+            else:
+                uploads.append((filename, path, key))
+        items = await asyncio.to_thread(collect_batch, uploads)
+    except BaseException as e:
+        for upload in uploads:
+            if not isinstance(upload, BatchItem):
+                remove_upload(upload[1])
+        if isinstance(e, BatchTooLarge):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+    # The zips are unpacked now; .xlsx uploads are removed by their job
+    for upload in uploads:
+        if not isinstance(upload, BatchItem) and upload[0].lower().endswith(".zip"):
+            remove_upload(upload[1])
+    await asyncio.to_thread(check_batch, items)
+
+    pending = [item for item in items if item.path is not None]
+    batch = []
+    try:
+        while pending or batch:
+            # Submitted while the queue has room, so a batch never has more
+            # than ADMISSION_QUEUE_LIMIT jobs waiting for memory
+            while pending and jobs.queue_room() > 0:
+                item = pending.pop(0)
+                job = await asyncio.to_thread(jobs.submit, item.path, item.filename, item.key)
+                batch.append((item, job.id))
+            states = await asyncio.to_thread(
+                lambda: [jobs.get(job_id) for _, job_id in batch]
+            )
+            for (item, _), job in zip(batch, states):
+                if job is None:
+                    # Pruned from the store before it was collected
+                    item.status, item.error = "failed", "The job has expired"
+                elif job.status in FINISHED_STATUSES:
+                    item.status, item.error, item.cached = job.status, job.error, job.cached
+                    item.result = job.result_name
+            batch = [(item, job_id) for item, job_id in batch if item.status == "queued"]
+            if pending or batch:
+                await asyncio.sleep(PROGRESS_POLL_SECONDS)
+    finally:
+        # Workbooks not submitted when the request ends have no job to remove them
+        for item in pending:
+            remove_upload(item.path)
+
+    # Results are read from the store one at a time and the zip spills to
+    # disk, so the batch is never held in memory as a whole
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        await asyncio.to_thread(write_batch, items, output, jobs.load_result)
+    except BaseException:
+        output.close()
+        raise
+    return StreamingResponse(
+        file_chunks(output),
+        media_type=ZIP_MEDIA_TYPE,
+        headers={
+            "Content-Disposition": attachment_header(BATCH_FILENAME),
+            "Content-Length": str(output.tell()),
+        },
     )
-    return JSONResponse({"uploaded": uploaded, "processed": processed})
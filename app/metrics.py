@@ -0,0 +1,198 @@
+import bisect
+import resource
+import threading
+from typing import Dict, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(mib * 1024 * 1024 for mib in (64, 128, 256, 512, 1024, 2048, 4096, 8192))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values[()] = 0
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+            for labels, value in sorted(values.items())
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, amount: float = 1, *labels: str):
+        self.inc(-amount, *labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> (count per bucket, sum, count)
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            entry = self._values.setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self._lock:
+            values = {labels: (list(c), s, n) for labels, (c, s, n) in self._values.items()}
+        lines = self.header()
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _labels(self.labelnames, labels, f'le="{_number(float(bound))}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "mediapoint_stage_seconds", "Seconds spent per pipeline stage.", SECONDS_BUCKETS, ("stage",)
+)
+pipeline_seconds = Histogram(
+    "mediapoint_pipeline_seconds", "Seconds per processed workbook.", SECONDS_BUCKETS
+)
+peak_rss = Histogram(
+    "mediapoint_pipeline_peak_rss_bytes",
+    "Peak resident memory of the process that ran the pipeline.",
+    BYTES_BUCKETS,
+)
+rows_processed = Counter("mediapoint_rows_processed_total", "Rows read from Bron.xlsx uploads.")
+input_bytes = Counter("mediapoint_input_bytes_total", "Bytes of processed uploads.")
+output_bytes = Counter("mediapoint_output_bytes_total", "Bytes of produced workbooks.")
+jobs_in_flight = Gauge("mediapoint_jobs_in_flight", "Workbooks queued or being processed.")
+jobs_total = Counter("mediapoint_jobs_total", "Finished pipeline runs by outcome.", ("status",))
+jobs_waiting = Gauge("mediapoint_jobs_waiting", "Jobs waiting for memory to start.")
+memory_reserved = Gauge(
+    "mediapoint_memory_reserved_bytes", "Estimated memory reserved by running pipelines."
+)
+admission_rejected = Counter(
+    "mediapoint_admission_rejected_total",
+    "Requests turned away for lack of memory or queue room.",
+    ("status",),
+)
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS (VmHWM) of this process, where supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_bytes() -> int:
+    """Peak RSS since the last reset_peak_rss(), or since the process started."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    # ru_maxrss is in KiB on Linux and never resets
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def record_run(stats: Dict):
+    """Record the stats of one process_excel_spooled run (see jobs.run_pipeline)."""
+    for stage, seconds in stats.get("stages", {}).items():
+        stage_seconds.observe(seconds, stage)
+    pipeline_seconds.observe(sum(stats.get("stages", {}).values()))
+    if stats.get("peak_rss_bytes"):
+        peak_rss.observe(stats["peak_rss_bytes"])
+    rows_processed.inc(stats.get("rows", 0))
+    input_bytes.inc(stats.get("input_bytes") or 0)
+    output_bytes.inc(stats.get("output_bytes") or 0)
+
+
+def render(cache_stats: Optional[Dict] = None) -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in (
+        stage_seconds,
+        pipeline_seconds,
+        peak_rss,
+        rows_processed,
+        input_bytes,
+        output_bytes,
+        jobs_in_flight,
+        jobs_total,
+        jobs_waiting,
+        memory_reserved,
+        admission_rejected,
+    ):
+        lines.extend(metric.render())
+    if cache_stats is not None:
+        for name, key, kind in (
+            ("mediapoint_cache_hits_total", "hits", "counter"),
+            ("mediapoint_cache_misses_total", "misses", "counter"),
+            ("mediapoint_cache_memory_hits_total", "memory_hits", "counter"),
+            ("mediapoint_cache_bytes", "bytes", "gauge"),
+            ("mediapoint_cache_store_bytes", "store_bytes", "gauge"),
+        ):
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {cache_stats[key]}")
+    return "\n".join(lines) + "\n"
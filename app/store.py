@@ -0,0 +1,420 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from typing import Any, Dict, Optional
+
+# Job metadata (SQLite) and result files shared by all server processes; on
+# a named volume (see docker-compose.yml) so they survive a restart of the
+# container
+STORE_DIR = os.environ.get("STORE_DIR", "/data/.store")
+# Owners (server processes running jobs) that have not reported for this
+# many heartbeat intervals are presumed gone and their jobs failed
+OWNER_TIMEOUT_HEARTBEATS = 3
+# Peak RSS measurements kept for calibrating the memory estimate
+MEMORY_SAMPLES_KEPT = 200
+# Total size of the stored results; the least recently used go first
+RESULT_STORE_BYTES = int(os.environ.get("RESULT_STORE_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    status TEXT NOT NULL,
+    finished_at REAL,
+    error TEXT,
+    cached INTEGER NOT NULL DEFAULT 0,
+    output_format TEXT NOT NULL,
+    sheets TEXT,
+    progress TEXT NOT NULL DEFAULT '{}',
+    key TEXT,
+    upload_path TEXT,
+    result_name TEXT,
+    etag TEXT,
+    owner TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    memory_estimate INTEGER,
+    peak_rss_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS owners (
+    id TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reservations (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memory_samples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    rows INTEGER NOT NULL,
+    input_bytes INTEGER NOT NULL,
+    peak_rss_bytes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    file TEXT PRIMARY KEY,
+    etag TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    path TEXT NOT NULL,
+    key TEXT NOT NULL,
+    uploaded_at REAL NOT NULL,
+    processed_at REAL
+);
+"""
+
+# Columns added to the jobs table after its first release, with their type
+_ADDED_JOB_COLUMNS = {"memory_estimate": "INTEGER", "peak_rss_bytes": "INTEGER"}
+
+_UNFINISHED = ("queued", "running")
+
+logger = logging.getLogger(__name__)
+
+
+def store_dir():
+    """
+    STORE_DIR, or a directory in the system temp dir when the parent of
+    STORE_DIR does not exist (e.g. /data outside the container). A STORE_DIR
+    that exists but cannot be written is an error: a temp dir would not be
+    shared between containers nor survive a new one.
+    """
+    parent = os.path.dirname(os.path.abspath(STORE_DIR))
+    if not os.path.isdir(parent):
+        fallback = os.path.join(tempfile.gettempdir(), "mediapoint-store")
+        logger.warning(
+            "%s does not exist; keeping jobs and results in %s instead", parent, fallback
+        )
+        os.makedirs(os.path.join(fallback, "results"), exist_ok=True)
+        return fallback
+    try:
+        os.makedirs(os.path.join(STORE_DIR, "results"), exist_ok=True)
+    except OSError as e:
+        raise OSError(f"Cannot create the job store in {STORE_DIR}: {e}") from e
+    return STORE_DIR
+
+
+def atomic_write(path: str, data):
+    """Write ``data`` to ``path`` through a synced temp file, so readers see all or nothing."""
+    directory = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".tmp-", delete=False) as temp:
+        try:
+            temp.write(data)
+            temp.flush()
+            os.fsync(temp.fileno())
+        except BaseException:
+            temp.close()
+            os.remove(temp.name)
+            raise
+    os.replace(temp.name, path)
+
+
+class JobStore:
+    """
+    Jobs, the state of the single-file /upload flow and the results, shared
+    through a directory that every server process (and pipeline worker)
+    opens: metadata in an SQLite database in WAL mode, results as files
+    named after their result cache key. Every method opens its own
+    connection, so a JobStore can be passed to worker processes.
+    """
+
+    def __init__(
+        self, directory: Optional[str] = None, max_result_bytes: int = RESULT_STORE_BYTES
+    ):
+        self.directory = directory or store_dir()
+        self.max_result_bytes = max_result_bytes
+        self.results_dir = os.path.join(self.directory, "results")
+        os.makedirs(self.results_dir, exist_ok=True)
+        self.path = os.path.join(self.directory, "jobs.sqlite3")
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            existing = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+            for column, kind in _ADDED_JOB_COLUMNS.items():
+                if column not in existing:
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _execute(self, sql: str, params=()) -> int:
+        with closing(self._connect()) as db, db:
+            return db.execute(sql, params).rowcount
+
+    def _fetch(self, sql: str, params=()):
+        with closing(self._connect()) as db:
+            return db.execute(sql, params).fetchone()
+
+    # Jobs
+
+    def create_job(self, job: Dict[str, Any]):
+        job = _encode(job)
+        columns = ", ".join(job)
+        self._execute(
+            f"INSERT INTO jobs ({columns}) VALUES ({', '.join('?' * len(job))})",
+            tuple(job.values()),
+        )
+
+    def update_job(self, job_id: str, **fields) -> bool:
+        fields = _encode(fields)
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        return bool(
+            self._execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id)
+            )
+        )
+
+    def start_job(self, job_id: str):
+        self._execute(
+            "UPDATE jobs SET status = 'running' WHERE id = ? AND status = 'queued'", (job_id,)
+        )
+
+    def finish_job(self, job_id: str, **fields) -> bool:
+        """Update a job that has not finished yet; False when it already has."""
+        fields = _encode(fields)
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        return bool(
+            self._execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND status IN (?, ?)",
+                (*fields.values(), job_id, *_UNFINISHED),
+            )
+        )
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._fetch("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        if row is None:
+            return None
+        job = dict(row)
+        job["cached"] = bool(job["cached"])
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        job["progress"] = json.loads(job["progress"])
+        if job["sheets"] is not None:
+            job["sheets"] = tuple(json.loads(job["sheets"]))
+        return job
+
+    def request_cancel(self, job_id: str) -> bool:
+        """Flag an unfinished job for cancelling; False when it has finished."""
+        return bool(
+            self._execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN (?, ?)",
+                (job_id, *_UNFINISHED),
+            )
+        )
+
+    def cancel_requested(self, job_id: str) -> bool:
+        row = self._fetch("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,))
+        return row is not None and bool(row[0])
+
+    # Memory reservations (see app.admission)
+
+    def reserve(
+        self, reservation: str, owner: str, size: int, budget: int, heartbeat_seconds: float
+    ) -> bool:
+        """
+        Reserve ``size`` bytes of the memory ``budget`` for ``owner``, which
+        must be sending heartbeats. Succeeds when it fits next to the
+        reservations of live owners, or when there are none.
+        """
+        cutoff = time.time() - heartbeat_seconds * OWNER_TIMEOUT_HEARTBEATS
+        with closing(self._connect()) as db:
+            # BEGIN IMMEDIATE: no other process can reserve in between
+            db.isolation_level = None
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                count, reserved = db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM reservations"
+                    " WHERE owner IN (SELECT id FROM owners WHERE seen_at >= ?)",
+                    (cutoff,),
+                ).fetchone()
+                admitted = count == 0 or reserved + size <= budget
+                if admitted:
+                    db.execute(
+                        "INSERT OR REPLACE INTO reservations (id, owner, bytes) VALUES (?, ?, ?)",
+                        (reservation, owner, size),
+                    )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return admitted
+
+    def release(self, reservation: str):
+        self._execute("DELETE FROM reservations WHERE id = ?", (reservation,))
+
+    def add_memory_sample(self, rows: int, input_bytes: int, peak_rss_bytes: int):
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "INSERT INTO memory_samples (rows, input_bytes, peak_rss_bytes) VALUES (?, ?, ?)",
+                (rows, input_bytes, peak_rss_bytes),
+            )
+            # Only the most recent samples are used (see MemoryEstimator)
+            db.execute(
+                "DELETE FROM memory_samples WHERE id <= (SELECT MAX(id) FROM memory_samples) - ?",
+                (MEMORY_SAMPLES_KEPT,),
+            )
+
+    def memory_samples(self, limit: int):
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                "SELECT rows, input_bytes, peak_rss_bytes FROM memory_samples"
+                " ORDER BY id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def heartbeat(self, owner: str):
+        self._execute(
+            "INSERT INTO owners (id, seen_at) VALUES (?, ?)"
+            " ON CONFLICT (id) DO UPDATE SET seen_at = excluded.seen_at",
+            (owner, time.time()),
+        )
+
+    # Results
+
+    def result_path(self, name: str) -> str:
+        return os.path.join(self.results_dir, hashlib.sha256(name.encode()).hexdigest())
+
+    def put_result(self, name: str, data, etag: str):
+        """Store the result ``name`` with its ETag, so serving it needs no hashing."""
+        path = self.result_path(name)
+        atomic_write(path, data)
+        self._execute(
+            "INSERT OR REPLACE INTO results (file, etag) VALUES (?, ?)",
+            (os.path.basename(path), etag),
+        )
+
+    def result_etag(self, name: str) -> Optional[str]:
+        """The ETag of the stored result ``name``, marking it as used; None once evicted."""
+        path = self.result_path(name)
+        row = self._fetch("SELECT etag FROM results WHERE file = ?", (os.path.basename(path),))
+        if row is None:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return row[0]
+
+    def read_result(self, name: str) -> Optional[bytes]:
+        """The stored result ``name``, marking it as used; None once evicted."""
+        path = self.result_path(name)
+        try:
+            with open(path, "rb") as result:
+                data = result.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def results_bytes(self) -> int:
+        total = 0
+        for name in os.listdir(self.results_dir):
+            try:
+                total += os.stat(os.path.join(self.results_dir, name)).st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    # The /upload, /run and /download flow
+
+    def get_upload(self) -> Optional[Dict[str, Any]]:
+        row = self._fetch("SELECT * FROM upload WHERE id = 1")
+        return dict(row) if row is not None else None
+
+    def set_upload(self, path: str, key: str) -> Optional[str]:
+        """Replace the current upload; returns the path of the previous one."""
+        with closing(self._connect()) as db, db:
+            previous = db.execute("SELECT path FROM upload WHERE id = 1").fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO upload (id, path, key, uploaded_at) VALUES (1, ?, ?, ?)",
+                (path, key, time.time()),
+            )
+        return previous[0] if previous is not None else None
+
+    def mark_processed(self, path: str):
+        self._execute(
+            "UPDATE upload SET processed_at = ? WHERE id = 1 AND path = ?", (time.time(), path)
+        )
+
+    def clear_upload(self, path: str) -> bool:
+        return bool(self._execute("DELETE FROM upload WHERE id = 1 AND path = ?", (path,)))
+
+    # Eviction
+
+    def prune(self, ttl: float, heartbeat_seconds: float):
+        """
+        Evict jobs that finished more than ``ttl`` seconds ago and results
+        unused for that long or beyond ``max_result_bytes`` (least recently
+        used first), and fail the unfinished jobs of owners that
+        have not sent a heartbeat for OWNER_TIMEOUT_HEARTBEATS intervals
+        (e.g. after a restart), releasing their memory reservations.
+        Returns the upload files of the failed jobs.
+        """
+        now = time.time()
+        owner_cutoff = now - heartbeat_seconds * OWNER_TIMEOUT_HEARTBEATS
+        with closing(self._connect()) as db, db:
+            orphans = db.execute(
+                "SELECT id, upload_path FROM jobs WHERE status IN (?, ?) AND (owner IS NULL"
+                " OR owner NOT IN (SELECT id FROM owners WHERE seen_at >= ?))",
+                (*_UNFINISHED, owner_cutoff),
+            ).fetchall()
+            db.executemany(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?"
+                " WHERE id = ? AND status IN (?, ?)",
+                [
+                    ("Interrupted: the server process stopped", now, row["id"], *_UNFINISHED)
+                    for row in orphans
+                ],
+            )
+            db.execute("DELETE FROM jobs WHERE finished_at < ?", (now - ttl,))
+            db.execute(
+                "DELETE FROM reservations WHERE owner NOT IN"
+                " (SELECT id FROM owners WHERE seen_at >= ?)",
+                (owner_cutoff,),
+            )
+            db.execute("DELETE FROM owners WHERE seen_at < ?", (owner_cutoff,))
+        files = []
+        for name in os.listdir(self.results_dir):
+            try:
+                info = os.stat(os.path.join(self.results_dir, name))
+            except FileNotFoundError:
+                continue
+            files.append((info.st_mtime, info.st_size, name))
+        # Least recently used first (see read_result and result_etag)
+        files.sort()
+        # Temp files of results being written only go once expired
+        total = sum(size for _, size, name in files if not name.startswith(".tmp-"))
+        evicted = []
+        for used_at, size, name in files:
+            writing = name.startswith(".tmp-")
+            if used_at >= now - ttl and (writing or total <= self.max_result_bytes):
+                continue
+            try:
+                os.remove(os.path.join(self.results_dir, name))
+            except FileNotFoundError:
+                pass
+            if not writing:
+                total -= size
+            evicted.append((name,))
+        if evicted:
+            with closing(self._connect()) as db, db:
+                db.executemany("DELETE FROM results WHERE file = ?", evicted)
+        return [row["upload_path"] for row in orphans if row["upload_path"]]
+
+
+def _encode(fields: Dict[str, Any]) -> Dict[str, Any]:
+    encoded = dict(fields)
+    if "progress" in encoded:
+        encoded["progress"] = json.dumps(encoded["progress"])
+    if encoded.get("sheets") is not None:
+        encoded["sheets"] = json.dumps(list(encoded["sheets"]))
+    return encoded
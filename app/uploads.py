@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+from fastapi import HTTPException, UploadFile
+
+from app.cache import cache_hasher
+
+# Uploads are spooled to disk here (the mounted /data volume in Docker)
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "/data/.uploads")
+# Largest accepted upload; bigger files are rejected with 413
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+def upload_dir():
+    """UPLOAD_DIR when it can be created, otherwise the system temp dir."""
+    try:
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+    except OSError:
+        return None
+    return UPLOAD_DIR
+
+
+def remove_upload(path):
+    if path is None:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def spool_upload(file: UploadFile, suffixes=(".xlsx",)):
+    """
+    Copy an .xlsx upload (or one of the other ``suffixes``) chunk by chunk
+    into a file in UPLOAD_DIR, hashing it on the way, so the upload is never
+    held in memory as a whole.
+
+    Returns the path of the spooled file and its result cache key. Raises
+    400 for other or empty uploads and 413 once MAX_UPLOAD_BYTES is
+    exceeded.
+    """
+    suffix = os.path.splitext(file.filename or "")[1].lower()
+    if suffix not in suffixes:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Only {' and '.join(suffixes)} files are supported",
+        )
+    hasher = cache_hasher()
+    size = 0
+    with tempfile.NamedTemporaryFile(
+        dir=upload_dir(), prefix="upload-", suffix=suffix, delete=False
+    ) as spooled:
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Upload exceeds the limit of {MAX_UPLOAD_BYTES} bytes",
+                    )
+                hasher.update(chunk)
+                spooled.write(chunk)
+            if size == 0:
+                raise HTTPException(status_code=400, detail="Uploaded file is empty")
+        except BaseException:
+            spooled.close()
+            remove_upload(spooled.name)
+            raise
+    return spooled.name, hasher.hexdigest()
@@ -0,0 +1,160 @@
+"""
+Seeded generator for synthetic Bron.xlsx member files.
+
+    python -m benchmarks.generate 10000 Bron.xlsx --seed 7
+"""
+
+import argparse
+import datetime
+import random
+
+import xlsxwriter
+
+HEADER = [
+    "Contractnummer",
+    "Abonneenummer",
+    "Voornaam",
+    "Tussenvoegsel",
+    "Naam",
+    "Straat",
+    "Huisnummer",
+    "Toevoeging",
+    "Postcode",
+    "Plaats",
+    "Land",
+    "Email",
+    "Geboortedatum",
+    "Vanaf",
+    "Toorts",
+    "Pas fysiek",
+    "Pas digitaal",
+]
+
+FIRST_NAMES = ["Jan", "Piet", "Anna", "Els", "Kees", "Sanne", "Daan", "Fleur", "Bram", "Lotte"]
+INFIXES = ["van", "de", "van der", "van den", "ter"]
+LAST_NAMES = ["Jansen", "de Vries", "Bakker", "Visser", "Smit", "Meijer", "Mulder", "Bos"]
+STREETS = ["Dorpsstraat", "Kerkweg", "Molenlaan", "Stationsweg", "Schoolstraat", "Julianalaan"]
+PLACES = ["Utrecht", "Zeist", "Houten", "Bunnik", "Amersfoort", "Nieuwegein"]
+SUFFIXES = ["A", "B", "bis", "2", "hs"]
+
+
+def generate_rows(
+    rows,
+    seed=0,
+    address_share=0.35,
+    email_share=0.6,
+    toorts_share=0.3,
+    max_family_size=6,
+    family_alpha=1.6,
+):
+    """
+    Yield ``rows`` member rows grouped in households of 1..max_family_size
+    members, with Pareto-distributed sizes (a smaller ``family_alpha`` gives
+    larger families). Within a household members share the address with probability
+    ``address_share`` and the email address with probability
+    ``email_share``; ``toorts_share`` of the households has one toorts
+    member. The same seed always yields the same rows.
+    """
+    rng = random.Random(seed)
+    member = 0
+    contract = 0
+    household = 0
+    while member < rows:
+        household += 1
+        size = min(rows - member, max_family_size, int(rng.paretovariate(family_alpha)))
+        postcode = f"{rng.randint(1000, 9999)} {rng.choice('ABCDEFGHJK')}{rng.choice('LMNPRSTVWX')}"
+        address = (
+            rng.choice(STREETS),
+            rng.randint(1, 400),
+            rng.choice(SUFFIXES) if rng.random() < 0.15 else None,
+            postcode,
+            rng.choice(PLACES),
+        )
+        last_name = rng.choice(LAST_NAMES)
+        infix = rng.choice(INFIXES) if rng.random() < 0.3 else None
+        email = f"huishouden{household}@example.nl"
+        toorts_member = rng.randrange(size) if rng.random() < toorts_share else None
+        contract += 1
+        for position in range(size):
+            member += 1
+            shares_address = position == 0 or rng.random() < address_share
+            if not shares_address:
+                address = (
+                    rng.choice(STREETS),
+                    rng.randint(1, 400),
+                    None,
+                    f"{rng.randint(1000, 9999)} {rng.choice('ABCDEFGHJK')}{rng.choice('LMNPRSTVWX')}",
+                    rng.choice(PLACES),
+                )
+            if position > 0 and rng.random() >= email_share:
+                member_email = f"lid{member}@example.nl"
+            else:
+                member_email = email
+            if rng.random() < 0.02:
+                member_email = member_email.upper()
+            street, number, suffix, member_postcode, place = address
+            yield [
+                contract if rng.random() < 0.8 else contract + rows,
+                100000 + member,
+                rng.choice(FIRST_NAMES),
+                infix,
+                last_name,
+                street,
+                number,
+                suffix,
+                member_postcode,
+                place,
+                "Nederland" if rng.random() < 0.95 else "België",
+                member_email,
+                datetime.datetime(1935, 1, 1) + datetime.timedelta(days=rng.randint(0, 32000)),
+                datetime.datetime(2015, 1, 1) + datetime.timedelta(days=rng.randint(0, 3500)),
+                1 if position == toorts_member else 0,
+                "Ja" if rng.random() < 0.6 else "Nee",
+                "Ja" if rng.random() < 0.7 else "Nee",
+            ]
+
+
+def generate_bron(path, rows, seed=0, **options):
+    """Write a synthetic Bron.xlsx with ``rows`` members to ``path``."""
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        worksheet = workbook.add_worksheet("Leden")
+        date_format = workbook.add_format({"num_format": "dd-mm-yyyy"})
+        worksheet.write_row(0, 0, HEADER)
+        for row, values in enumerate(generate_rows(rows, seed, **options), start=1):
+            for col, value in enumerate(values):
+                if value is None:
+                    continue
+                if isinstance(value, datetime.datetime):
+                    worksheet.write_datetime(row, col, value, date_format)
+                else:
+                    worksheet.write(row, col, value)
+    finally:
+        workbook.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("rows", type=int)
+    parser.add_argument("path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--address-share", type=float, default=0.35)
+    parser.add_argument("--email-share", type=float, default=0.6)
+    parser.add_argument("--toorts-share", type=float, default=0.3)
+    parser.add_argument("--max-family-size", type=int, default=6)
+    parser.add_argument("--family-alpha", type=float, default=1.6)
+    args = parser.parse_args(argv)
+    generate_bron(
+        args.path,
+        args.rows,
+        seed=args.seed,
+        address_share=args.address_share,
+        email_share=args.email_share,
+        toorts_share=args.toorts_share,
+        max_family_size=args.max_family_size,
+        family_alpha=args.family_alpha,
+    )
+
+
+if __name__ == "__main__":
+    main()
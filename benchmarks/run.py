@@ -0,0 +1,234 @@
+"""
+Scalability benchmark for the Bron.xlsx pipeline.
+
+Runs every pipeline stage on synthetic member files of increasing size, in
+a fresh process per size, and records wall time and peak RSS per stage.
+
+    python -m benchmarks.run --sizes 1k,10k --output results.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json --save-baseline
+    python -m benchmarks.run --baseline benchmarks/baseline.json --threshold 1.3
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from benchmarks.generate import generate_bron
+
+DEFAULT_SIZES = "1k,10k,100k,500k"
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+MB = 1024 * 1024
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    if text.endswith("k"):
+        return int(float(text[:-1]) * 1000)
+    if text.endswith("m"):
+        return int(float(text[:-1]) * 1000000)
+    return int(text)
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is in KiB on Linux; only the process-wide peak is known
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler(threading.Thread):
+    """Samples the RSS of this process to find the peak of each stage."""
+
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss()
+        self._stopped = threading.Event()
+
+    def reset(self):
+        self.peak = current_rss()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def run_stages(path):
+    """Run the pipeline stage by stage on ``path``; executed in a fresh process."""
+    import excel_processor
+
+    sampler = RssSampler()
+    sampler.start()
+    stages = {}
+
+    def measure(name, func, *args):
+        sampler.reset()
+        started = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - started
+        stages[name] = {
+            "seconds": round(seconds, 4),
+            "peak_rss_mb": round(max(sampler.peak, current_rss()) / MB, 1),
+        }
+        return result
+
+    def transform(df):
+        # Timed per pipeline stage (derive, households, fysiek, digitaal), so a
+        # regression in one classification is not diluted by the others.
+        # transform_frame reports every stage start, which closes the RSS peak
+        # of the previous stage.
+        timings, peaks, started = {}, {}, []
+
+        def progress(stage, **info):
+            if started:
+                peaks[started[-1]] = max(sampler.peak, current_rss())
+            sampler.reset()
+            started.append(stage)
+
+        df = excel_processor.transform_frame(df, timings, progress=progress)
+        peaks[started[-1]] = max(sampler.peak, current_rss())
+        for name, seconds in timings.items():
+            stages[name] = {
+                "seconds": round(seconds, 4),
+                "peak_rss_mb": round(peaks[name] / MB, 1),
+            }
+        return df
+
+    try:
+        df, _ = measure("read", excel_processor.read_source, path)
+        df = transform(df)
+        sheets = measure("sheets", excel_processor.build_sheets, df)
+        with tempfile.TemporaryFile() as output:
+            measure("write", excel_processor.write_workbook, sheets, output)
+    finally:
+        sampler.stop()
+    return stages
+
+
+def input_path(rows, seed, data_dir):
+    path = os.path.join(data_dir, f"bron-{rows}-seed{seed}.xlsx")
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        print(f"Generating {rows} rows -> {path}", file=sys.stderr)
+        generate_bron(path + ".tmp", rows, seed=seed)
+        os.replace(path + ".tmp", path)
+    return path
+
+
+def run_benchmark(sizes, seed=0, data_dir=DATA_DIR):
+    import numpy
+    import pandas
+
+    results = {}
+    for rows in sizes:
+        path = input_path(rows, seed, data_dir)
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            stages = pool.submit(run_stages, path).result()
+        total = sum(stage["seconds"] for stage in stages.values())
+        results[str(rows)] = {
+            "rows": rows,
+            "stages": stages,
+            "total_seconds": round(total, 4),
+            "peak_rss_mb": max(stage["peak_rss_mb"] for stage in stages.values()),
+            "us_per_row": round(total / rows * 1e6, 2),
+        }
+        print(
+            f"{rows:>8} rows  {total:8.2f}s  "
+            + "  ".join(f"{name} {stage['seconds']:.2f}s" for name, stage in stages.items())
+            + f"  peak {results[str(rows)]['peak_rss_mb']:.0f} MB",
+            file=sys.stderr,
+        )
+    return {
+        "meta": {
+            "seed": seed,
+            "python": platform.python_version(),
+            "pandas": pandas.__version__,
+            "numpy": numpy.__version__,
+            "cpu_count": os.cpu_count(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def find_regressions(report, baseline, threshold, min_seconds=0.05):
+    """
+    Compare every stage against the baseline report and describe each one
+    whose wall time or peak RSS grew beyond ``threshold`` times the baseline.
+    Time differences below ``min_seconds`` are treated as noise.
+    """
+    regressions = []
+    for size, entry in report["results"].items():
+        base_entry = baseline.get("results", {}).get(size)
+        if base_entry is None:
+            continue
+        for name, stage in entry["stages"].items():
+            base = base_entry["stages"].get(name)
+            if base is None:
+                continue
+            if (
+                stage["seconds"] > base["seconds"] * threshold
+                and stage["seconds"] - base["seconds"] > min_seconds
+            ):
+                regressions.append(
+                    f"{size} rows, {name}: {base['seconds']:.2f}s -> {stage['seconds']:.2f}s"
+                )
+            if stage["peak_rss_mb"] > base["peak_rss_mb"] * threshold:
+                regressions.append(
+                    f"{size} rows, {name}: peak RSS {base['peak_rss_mb']:.0f} MB"
+                    f" -> {stage['peak_rss_mb']:.0f} MB"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Bron.xlsx pipeline")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="e.g. 1k,10k,100k,500k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=DATA_DIR, help="where generated inputs are kept")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as --baseline")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args(argv)
+    if args.baseline and not args.save_baseline and not os.path.exists(args.baseline):
+        parser.error(f"baseline {args.baseline} does not exist (use --save-baseline to create it)")
+
+    sizes = [parse_size(size) for size in args.sizes.split(",") if size.strip()]
+    report = run_benchmark(sizes, seed=args.seed, data_dir=args.data_dir)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as output:
+            json.dump(report, output, indent=2)
+    elif args.baseline:
+        with open(args.baseline) as handle:
+            regressions = find_regressions(report, json.load(handle), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,20 @@
 import pandas as pd
 import numpy as np
+import datetime
 import os
+import posixpath
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from io import BytesIO
+from multiprocessing import get_context, shared_memory, util
+from typing import Dict, Optional, Tuple
+from xml.etree import ElementTree
+
+import xlsxwriter
 
 """
 Local processing entrypoint compatible with the previous Lambda interface.
@@ -12,6 +25,104 @@ Reads "/data/Bron.xlsx" and writes "/data/Modified_Bron.xlsx".
 local_file_path = "/data/Bron.xlsx"
 modified_file_path = "/data/Modified_Bron.xlsx"
 
+# Bump whenever a change alters the produced workbook; part of the result
+# cache key so stale cached results are never served
+PIPELINE_VERSION = "3"
+
+# Number of fam1..famN columns on the "Digitaal 2p+" sheet
+MAX_FAMILY_SLOTS = int(os.environ.get("MAX_FAMILY_SLOTS", "4"))
+
+# Preferred xlsx reader: "calamine", "openpyxl" or "auto" (fastest available)
+READER_ENGINE = os.environ.get("READER_ENGINE", "auto")
+READER_ENGINES = ("calamine", "openpyxl")
+
+# Working frame dtypes: "default" or "compact" (categoricals, downcast ints
+# and missing text kept as missing instead of 0; see compare_dtype_modes)
+DTYPE_MODE = os.environ.get("DTYPE_MODE", "default")
+DTYPE_MODES = ("default", "compact")
+
+# Processes that select the letter recipients and classify the households in
+# parallel, each taking the rows of a share of the contract or email keys
+# (0 or 1 classifies in the calling process)
+CLASSIFY_WORKERS = int(os.environ.get("CLASSIFY_WORKERS", "0"))
+
+# Measure column widths on at most this many rows per sheet (0 = all rows)
+COL_WIDTH_SAMPLE = int(os.environ.get("COL_WIDTH_SAMPLE", "0"))
+
+# Write sheets row by row in xlsxwriter's constant_memory mode ("streaming")
+# or through DataFrame.to_excel ("pandas")
+WRITER_MODE = os.environ.get("WRITER_MODE", "streaming")
+# The streaming writer reports progress (and can be cancelled) every this
+# many rows of a sheet
+PROGRESS_ROWS = 5000
+# Rows below the header whose cell types check_source samples
+SCHEMA_SAMPLE_ROWS = 100
+# Workbooks up to this size stay in memory, larger ones spill to a temp file
+SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# "xlsx" writes the workbook; "csv" and "parquet" write a zip with one file
+# per sheet (parquet needs pyarrow, see available_output_formats)
+OUTPUT_FORMATS = ("xlsx", "csv", "parquet")
+
+# Number formats of date-only and datetime cells in the written workbook
+DATE_FORMAT = "dd-mm-yyyy"
+DATETIME_FORMAT = "YYYY-MM-DD HH:MM:SS"
+
+_MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_PACKAGE_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# Columns of Bron.xlsx the pipeline works with. Text columns are loaded as
+# strings so that e.g. numeric postcodes or toevoegingen behave like text.
+TEXT_COLUMNS = (
+    "voornaam",
+    "tussenvoegsel",
+    "naam",
+    "straat",
+    "toevoeging",
+    "postcode",
+    "plaats",
+    "land",
+    "email",
+    "pas fysiek",
+    "pas digitaal",
+)
+# Classification steps a sheet can depend on: the fysiek 1p/2p+ split, the
+# fysiek 2p+ brieven selection, the digitaal 1p/2p+ split and the MailChimp
+# and family classification of shared email addresses
+CLASSIFICATION_STEPS = ("fysiek", "letters", "digitaal", "families")
+
+# Low-cardinality text columns stored as categoricals in the compact mode
+CATEGORY_COLUMNS = ("tussenvoegsel", "toevoeging", "plaats", "land", "pas fysiek", "pas digitaal")
+SOURCE_COLUMNS = TEXT_COLUMNS + (
+    "contractnummer",
+    "abonneenummer",
+    "huisnummer",
+    "geboortedatum",
+    "vanaf",
+    "toorts",
+)
+# Source columns that must hold numbers and dates (checked by check_source)
+NUMBER_COLUMNS = ("toorts",)
+DATE_COLUMNS = ("geboortedatum", "vanaf")
+
+
+@contextmanager
+def timed(timings, stage, progress=None, **info):
+    """
+    Add the seconds spent in the block to ``timings[stage]``, if given. The
+    start of the stage is first reported as ``progress(stage, **info)``; a
+    progress callback may raise to cancel the run between stages.
+    """
+    if progress is not None:
+        progress(stage, **info)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
 
 def lambda_handler(event, context):
     try:
@@ -23,11 +134,54 @@ def lambda_handler(event, context):
 
 
 def process_excel_file(input_file_path, output_file_path):
-    df = pd.read_excel(input_file_path).fillna(0)
-    df.columns = df.columns.str.lower()
+    df, _ = read_source(input_file_path)
+    write_workbook(build_sheets(transform_frame(df)), output_file_path)
+
+    print("File processed and saved successfully with additional sheets.")
+
+
+def transform_frame(
+    df, timings=None, mode=None, steps=CLASSIFICATION_STEPS, progress=None, workers=None
+):
+    """
+    Derive the name and address columns and the fysiek/digitaal
+    classification flags on the frame read from Bron.xlsx. Only the
+    CLASSIFICATION_STEPS in ``steps`` run; the flags of skipped steps stay
+    False. ``mode`` is one of DTYPE_MODES (default DTYPE_MODE) and
+    ``workers`` the number of classification processes (default
+    CLASSIFY_WORKERS). Seconds per stage are added to ``timings`` and stage
+    starts reported to ``progress`` (see timed) when given.
+    """
+    compact = (mode or DTYPE_MODE) == "compact"
+    with timed(timings, "derive", progress, rows=len(df)):
+        df = derive_columns(df, compact)
+    with timed(timings, "households", progress):
+        households = HouseholdIndex.build(df, steps)
+    if "fysiek" in steps or "letters" in steps:
+        with timed(timings, "fysiek", progress):
+            classify_fysiek(df, households, letters="letters" in steps, workers=workers)
+    if "digitaal" in steps or "families" in steps:
+        with timed(timings, "digitaal", progress):
+            classify_digitaal(df, households, families="families" in steps, workers=workers)
+    if compact:
+        with timed(timings, "compact", progress):
+            compact_frame(df)
+    return df
+
+
+def _is_text(dtype):
+    return dtype == object or isinstance(dtype, pd.StringDtype)
+
+
+def derive_columns(df, compact=False):
+    if compact:
+        # Missing text stays missing instead of putting 0 in string columns
+        df = df.fillna({col: 0 for col, dtype in df.dtypes.items() if not _is_text(dtype)})
+    else:
+        df = df.fillna(0)
+        df["postcode"] = df["postcode"].astype(str)
     df["land"] = df["land"].replace("Nederland", "")
     df["email"] = df["email"].str.lower()
-    df["postcode"] = df["postcode"].astype(str)
 
     df.insert(0, "card", 2)
     df.insert(0, "fam", np.nan)
@@ -46,553 +200,964 @@ def process_excel_file(input_file_path, output_file_path):
     df.insert(0, "fysiek 1p", False)
     df.insert(0, "fysiek", False)
 
-    df["name"] = (
-        df["tussenvoegsel"]
-        .replace(0, "")
-        .apply(lambda x: x.strip() + " " if x.strip() != "" else "")
-        + df["naam"]
-    )
+    # Each fragment is built once with vectorized string ops and reused
+    voornaam, naam = _optional_text(df["voornaam"]), _optional_text(df["naam"])
+    straat, plaats = _optional_text(df["straat"]), _optional_text(df["plaats"])
+    postcode = _optional_text(df["postcode"])
+    tussenvoegsel = _optional_text(df["tussenvoegsel"])
+    has_tussenvoegsel = tussenvoegsel.str.strip() != ""
+    toevoeging = _optional_text(df["toevoeging"])
+    toevoeging_suffix = (" " + toevoeging).where(toevoeging.str.strip() != "", "")
+    huisnummer = df["huisnummer"].astype(str)
+
+    df["name"] = (tussenvoegsel.str.strip() + " ").where(has_tussenvoegsel, "") + naam
     df["naam compleet"] = (
-        df["voornaam"]
-        + df["tussenvoegsel"]
-        .replace(0, "")
-        .apply(lambda x: " " + x if x.strip() != "" else "")
-        + " "
-        + df["naam"]
-    )
-    df["straat compleet"] = (
-        df["straat"]
-        + " "
-        + df["huisnummer"].astype(str)
-        + df["toevoeging"]
-        .replace(0, "")
-        .replace("", "")
-        .apply(lambda x: " " + x if x.strip() != "" else "")
-    )
-    df["plaats compleet"] = df["postcode"] + "  " + df["plaats"]
-    df["postcode huisnummer toevoeging"] = (
-        df["postcode"]
-        + " "
-        + df["huisnummer"].astype(str)
-        + df["toevoeging"]
-        .replace(0, "")
-        .replace("", "")
-        .apply(lambda x: " " + x if x.strip() != "" else "")
+        voornaam + (" " + tussenvoegsel).where(has_tussenvoegsel, "") + " " + naam
     )
+    df["straat compleet"] = straat + " " + huisnummer + toevoeging_suffix
+    df["plaats compleet"] = postcode + "  " + plaats
+    df["postcode huisnummer toevoeging"] = postcode + " " + huisnummer + toevoeging_suffix
     df["fam"] = df["naam compleet"] + " " + df["abonneenummer"].astype(str)
-    df["geboortedatum"] = pd.to_datetime(df["geboortedatum"]).dt.strftime("%d-%m-%Y")
-    df["vanaf"] = pd.to_datetime(df["vanaf"]).dt.strftime("%d-%m-%Y")
+    # Dates stay datetime64; DATE_FORMAT is applied when the workbook is written
+    df["geboortedatum"] = pd.to_datetime(df["geboortedatum"])
+    df["vanaf"] = pd.to_datetime(df["vanaf"])
+    return df
 
-    # Correct logic for fysiek classification based on postcode huisnummer toevoeging
-    address_unique = ~df.duplicated(
-        subset=["postcode huisnummer toevoeging"], keep=False
-    )
-    address_duplicate = df.duplicated(
-        subset=["postcode huisnummer toevoeging"], keep=False
-    )
 
-    df["fysiek"] = df["pas fysiek"] == "Ja"
-    df["fysiek 1p"] = address_unique & (df["pas fysiek"] == "Ja")
-    df["fysiek 2p+"] = address_duplicate & (df["pas fysiek"] == "Ja")
+def _optional_text(series):
+    """Text column with missing values (or their 0 placeholders) as empty strings."""
+    return series.replace(0, "").fillna("").astype(str)
 
-    filtered_df = df[df["fysiek 2p+"]]
-    unique_contracts = filtered_df["contractnummer"].unique()
 
-    for contract in unique_contracts:
-        subset = filtered_df[filtered_df["contractnummer"] == contract]
-        if (subset["toorts"] == 1).any():
-            first_toorts = subset[subset["toorts"] == 1].index[0]
-            df.loc[first_toorts, "fysiek 2p+ brieven"] = True
-        else:
-            if (subset["toorts"] == 0).all():
-                oldest = subset[
-                    subset["geboortedatum"] == subset["geboortedatum"].min()
-                ].index[0]
-                df.loc[oldest, "fysiek 2p+ brieven"] = True
+def compact_frame(df):
+    """
+    Shrink the working frame in place: integer columns (including the card
+    and fam_number columns) are downcast to the smallest integer type and the
+    CATEGORY_COLUMNS become categoricals. Flag columns are already 1-byte
+    NumPy bools.
+    """
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_integer_dtype(dtype):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+        elif col in CATEGORY_COLUMNS:
+            df[col] = df[col].astype("category")
 
-    df["digitaal"] = df["pas digitaal"] == "Ja"
-    df["digitaal 1p"] = df["digitaal"] & ~df["email"].duplicated(keep=False)
-    df["digitaal 2p+"] = df["digitaal"] & df["email"].duplicated(keep=False)
 
-    digital_2p_plus_df = df[df["digitaal 2p+"]]
-    unique_emails = digital_2p_plus_df["email"].unique()
+def column_memory(df):
+    """Deep memory usage in bytes of every column of ``df``."""
+    return df.memory_usage(index=False, deep=True)
 
-    for email in unique_emails:
-        subset = digital_2p_plus_df[digital_2p_plus_df["email"] == email]
-        if (subset["toorts"] == 1).any():
-            main_row_index = subset[subset["toorts"] == 1].index[0]
-        else:
-            main_row_index = subset["geboortedatum"].idxmin()
-        df.loc[main_row_index, "MailChimp"] = True
-        joining_rows = subset.index.difference([main_row_index])
-        df.loc[joining_rows, "MailChimp"] = False
-
-    df.loc[df["digitaal 1p"], "MailChimp"] = True
-
-    digital_2p_plus_family_df = df[df["digitaal 2p+"]].copy()
-    unique_emails_digital_family = digital_2p_plus_family_df["email"].unique()
-
-    for email in unique_emails_digital_family:
-        subset = digital_2p_plus_family_df[digital_2p_plus_family_df["email"] == email]
-        if (subset["toorts"] == 1).any():
-            main_row_index = subset[subset["toorts"] == 1].index[0]
-            main_email = subset.loc[main_row_index, "email"]
-            matching_emails_indices = subset[
-                (subset["email"] == main_email) & (subset.index != main_row_index)
-            ].index
-            df.loc[matching_emails_indices, "digitaal 2p+ family"] = True
-            family_subset = subset[subset["email"] != main_email]
-            if not family_subset.empty:
-                oldest_family_member_index = family_subset["geboortedatum"].idxmin()
-                df.loc[oldest_family_member_index, "digitaal 2p+ family"] = False
-                remaining_family_indices = family_subset.index.difference(
-                    [oldest_family_member_index]
-                )
-                df.loc[remaining_family_indices, "digitaal 2p+ family"] = True
-        else:
-            main_row_index = subset["geboortedatum"].idxmin()
-            main_email = subset.loc[main_row_index, "email"]
-            matching_emails_indices = subset[
-                (subset["email"] == main_email) & (subset.index != main_row_index)
-            ].index
-            df.loc[matching_emails_indices, "digitaal 2p+ family"] = True
-
-    digitaal_2p_plus_family_df = df[df["digitaal 2p+ family"]].copy()
-    unique_contracts = digitaal_2p_plus_family_df["email"].unique()
-
-    for contract in unique_contracts:
-        subset = digitaal_2p_plus_family_df[
-            digitaal_2p_plus_family_df["email"] == contract
-        ]
-        subset["geboortedatum"] = pd.to_datetime(
-            subset["geboortedatum"], format="%d-%m-%Y"
-        )
-        subset_sorted = subset.sort_values(by="geboortedatum")
-
-        for i, idx in enumerate(subset_sorted.index):
-            df.at[idx, "fam_number"] = i + 1
-
-    fysiek_columns = {
-        "Naam compleet": "naam compleet",
-        "Geboortedatum": "geboortedatum",
-        "Straat compleet": "straat compleet",
-        "Plaats compleet": "plaats compleet",
-        "Land": "land",
-        "Vanaf": "vanaf",
-        "Abonneenummer": "abonneenummer",
-        "toorts": "toorts",
-    }
 
-    fysiek_data = df[df["fysiek"]].copy()
-    fysiek_df = fysiek_data[list(fysiek_columns.values())]
-    fysiek_df.columns = list(fysiek_columns.keys())
+def compare_dtype_modes(source):
+    """
+    Transform ``source`` in every DTYPE_MODES mode and return the memory per
+    column of the resulting working frames (plus a "total" row), to see
+    what the compact mode saves on a real upload.
+    """
+    df, _ = read_source(source)
+    report = pd.DataFrame(
+        {mode: column_memory(transform_frame(df, mode=mode)) for mode in DTYPE_MODES}
+    )
+    report.loc["total"] = report.sum()
+    report["saved"] = report["default"] - report["compact"]
+    return report
 
-    fysiek_1p_data = df[df["fysiek 1p"]].copy()
-    fysiek_1p_df = fysiek_1p_data[list(fysiek_columns.values())]
-    fysiek_1p_df.columns = list(fysiek_columns.keys())
 
-    fysiek_2p_plus_data = df[df["fysiek 2p+"]].copy()
-    fysiek_2p_plus_df = fysiek_2p_plus_data[list(fysiek_columns.values())]
-    fysiek_2p_plus_df.columns = list(fysiek_columns.keys())
+def classify_fysiek(df, households, letters=True, workers=None):
+    # Correct logic for fysiek classification based on postcode huisnummer toevoeging
+    shared_address = households.address.shared()
 
-    fysiek_2p_plus_brieven_data = df[df["fysiek 2p+ brieven"]].copy()
-    fysiek_2p_plus_brieven_df = fysiek_2p_plus_brieven_data[
-        list(fysiek_columns.values())
-    ]
-    fysiek_2p_plus_brieven_df.columns = list(fysiek_columns.keys())
-
-    digitaal_columns = {
-        "contractnummer": "contractnummer",
-        "cardNumber": "abonneenummer",
-        "name": "naam compleet",
-        "birthday": "geboortedatum",
-        "email": "email",
-        "dynamicField": "vanaf",
-        "card": "card",
-    }
+    df["fysiek"] = df["pas fysiek"] == "Ja"
+    df["fysiek 1p"] = ~shared_address & df["fysiek"]
+    df["fysiek 2p+"] = shared_address & df["fysiek"]
 
-    digitaal_data = df[df["digitaal"]].copy()
-    digitaal_df = digitaal_data[list(digitaal_columns.values())]
-    digitaal_df.columns = list(digitaal_columns.keys())
-
-    digitaal_1p_data = df[df["digitaal 1p"]].copy()
-    digitaal_1p_df = digitaal_1p_data[list(digitaal_columns.values())]
-    digitaal_1p_df.columns = list(digitaal_columns.keys())
-
-    digitaal_2p_plus_data = df[
-        (df["digitaal 2p+"] == True) & (df["digitaal 2p+ family"] == False)
-    ].copy()
-    digitaal_2p_plus_df = digitaal_2p_plus_data[list(digitaal_columns.values())]
-    digitaal_2p_plus_df.columns = list(digitaal_columns.keys())
-
-    digitaal_2p_plus_df["fam1"] = ""
-    digitaal_2p_plus_df["fam2"] = ""
-    digitaal_2p_plus_df["fam3"] = ""
-    digitaal_2p_plus_df["fam4"] = ""
-    digitaal_2p_plus_df.loc[:, ["fam1", "fam2", "fam3", "fam4"]] = digitaal_2p_plus_df[
-        ["fam1", "fam2", "fam3", "fam4"]
-    ].astype(str)
-
-    family_true_df = df[df["digitaal 2p+ family"] == True]
-
-    for idx, row in family_true_df.iterrows():
-        fam_number = row["fam_number"]
-        if fam_number in [1, 2, 3, 4]:
-            fam_column = f"fam{int(fam_number)}"
-            matching_email_rows = digitaal_2p_plus_df["email"] == row["email"]
-            digitaal_2p_plus_df.loc[matching_email_rows, fam_column] = row["fam"]
-
-    mail_chimp_columns = {
-        "Email Address": "email",
-        "First": "voornaam",
-        "Name": "name",
-        "Lidmaatschapsnummer": "abonneenummer",
-    }
+    if letters:
+        df["fysiek 2p+ brieven"] = select_letter_recipients(df, households.contract, workers)
 
-    mail_chimp_data = df[df["MailChimp"]].copy()
-    mail_chimp_df = mail_chimp_data[list(mail_chimp_columns.values())]
-    mail_chimp_df.columns = list(mail_chimp_columns.keys())
 
-    # Remove duplicate emails in MailChimp
-    mail_chimp_df = mail_chimp_df.drop_duplicates(subset=["Email Address"])
+def classify_digitaal(df, households, families=True, workers=None):
+    shared_email = households.email.shared()
 
-    writer = pd.ExcelWriter(output_file_path, engine="xlsxwriter")
-    df.to_excel(writer, index=False, sheet_name="Main")
+    df["digitaal"] = df["pas digitaal"] == "Ja"
+    df["digitaal 1p"] = df["digitaal"] & ~shared_email
+    df["digitaal 2p+"] = df["digitaal"] & shared_email
+
+    if not families:
+        return
+    main, family, fam_number = classify_households(df, households.email, workers)
+    df["MailChimp"] = main | df["digitaal 1p"]
+    df["digitaal 2p+ family"] = family
+    df["fam_number"] = fam_number
+
+
+FYSIEK_COLUMNS = {
+    "Naam compleet": "naam compleet",
+    "Geboortedatum": "geboortedatum",
+    "Straat compleet": "straat compleet",
+    "Plaats compleet": "plaats compleet",
+    "Land": "land",
+    "Vanaf": "vanaf",
+    "Abonneenummer": "abonneenummer",
+    "toorts": "toorts",
+}
+DIGITAAL_COLUMNS = {
+    "contractnummer": "contractnummer",
+    "cardNumber": "abonneenummer",
+    "name": "naam compleet",
+    "birthday": "geboortedatum",
+    "email": "email",
+    "dynamicField": "vanaf",
+    "card": "card",
+}
+MAIL_CHIMP_COLUMNS = {
+    "Email Address": "email",
+    "First": "voornaam",
+    "Name": "name",
+    "Lidmaatschapsnummer": "abonneenummer",
+}
+
+
+@dataclass(frozen=True)
+class SheetSpec:
+    """
+    One output sheet: the rows where flag column ``rows`` is set (all rows
+    when None) and ``exclude`` is not, with ``columns`` renamed from working
+    frame names to sheet names (all columns when None) minus ``drop``.
+    ``unique`` keeps the first row per value of that sheet column and
+    ``family_slots`` appends the fam1..famN columns. ``needs`` lists the
+    CLASSIFICATION_STEPS the sheet depends on.
+    """
 
-    fysiek_df.to_excel(writer, index=False, sheet_name="Fysiek")
-    fysiek_1p_df.to_excel(writer, index=False, sheet_name="Fysiek 1p")
-    fysiek_2p_plus_df.to_excel(writer, index=False, sheet_name="Fysiek 2p+")
-    fysiek_2p_plus_brieven_df.to_excel(
-        writer, index=False, sheet_name="Fysiek 2p+ brieven"
-    )
+    name: str
+    needs: Tuple[str, ...]
+    rows: Optional[str] = None
+    columns: Optional[Dict[str, str]] = None
+    drop: Tuple[str, ...] = ()
+    exclude: Optional[str] = None
+    unique: Optional[str] = None
+    family_slots: bool = False
+
+
+SHEETS = (
+    SheetSpec("Main", CLASSIFICATION_STEPS),
+    SheetSpec("Fysiek", ("fysiek",), "fysiek", FYSIEK_COLUMNS),
+    SheetSpec("Fysiek 1p", ("fysiek",), "fysiek 1p", FYSIEK_COLUMNS),
+    SheetSpec("Fysiek 2p+", ("fysiek",), "fysiek 2p+", FYSIEK_COLUMNS),
+    SheetSpec("Fysiek 2p+ brieven", ("letters",), "fysiek 2p+ brieven", FYSIEK_COLUMNS),
+    SheetSpec("Digitaal", ("digitaal",), "digitaal", DIGITAAL_COLUMNS, drop=("contractnummer",)),
+    SheetSpec(
+        "Digitaal 1p", ("digitaal",), "digitaal 1p", DIGITAAL_COLUMNS, drop=("contractnummer",)
+    ),
+    SheetSpec(
+        "Digitaal 2p+",
+        ("families",),
+        "digitaal 2p+",
+        DIGITAAL_COLUMNS,
+        drop=("contractnummer",),
+        exclude="digitaal 2p+ family",
+        family_slots=True,
+    ),
+    SheetSpec(
+        "MailChimp", ("families",), "MailChimp", MAIL_CHIMP_COLUMNS, unique="Email Address"
+    ),
+)
+SHEET_NAMES = tuple(spec.name for spec in SHEETS)
+
+
+def select_sheets(names=None):
+    """
+    The SheetSpecs of the sheet ``names``, in workbook order; all sheets when
+    ``names`` is None. Raises ValueError for unknown sheet names.
+    """
+    if names is None:
+        return SHEETS
+    unknown = [name for name in names if name not in SHEET_NAMES]
+    if unknown:
+        raise ValueError(f"Unknown sheet(s): {', '.join(unknown)}")
+    return tuple(spec for spec in SHEETS if spec.name in names)
 
-    digitaal_df.drop(columns=["contractnummer"], inplace=True)
-    digitaal_df.to_excel(writer, index=False, sheet_name="Digitaal")
 
-    digitaal_1p_df.drop(columns=["contractnummer"], inplace=True)
-    digitaal_1p_df.to_excel(writer, index=False, sheet_name="Digitaal 1p")
+def required_steps(specs):
+    """The CLASSIFICATION_STEPS needed by ``specs``, in pipeline order."""
+    needed = {step for spec in specs for step in spec.needs}
+    return tuple(step for step in CLASSIFICATION_STEPS if step in needed)
 
-    digitaal_2p_plus_df.drop(columns=["contractnummer"], inplace=True)
-    digitaal_2p_plus_df.to_excel(writer, index=False, sheet_name="Digitaal 2p+")
 
-    mail_chimp_df.to_excel(writer, index=False, sheet_name="MailChimp")
+def build_sheet(df, spec):
+    """
+    Return the DataFrame of one SheetSpec. Rows and columns are selected in
+    a single .loc, so only the cells that end up on the sheet are copied.
+    """
+    if spec.rows is None and spec.columns is None:
+        return df
+    mask = df[spec.rows].to_numpy() if spec.rows is not None else np.ones(len(df), dtype=bool)
+    if spec.exclude is not None:
+        mask = mask & ~df[spec.exclude].to_numpy()
+    mapping = {
+        name: col
+        for name, col in (spec.columns or dict(zip(df.columns, df.columns))).items()
+        if name not in spec.drop
+    }
+    frame = df.loc[mask, list(mapping.values())]
+    frame.columns = list(mapping.keys())
+    if spec.family_slots:
+        for col, values in build_family_slots(df, frame["email"]).items():
+            frame[col] = values
+    if spec.unique is not None:
+        frame = frame.drop_duplicates(subset=[spec.unique])
+    return frame
 
-    workbook = writer.book
-    main_worksheet = writer.sheets["Main"]
 
-    fysiek_worksheet = writer.sheets["Fysiek"]
-    fysiek_1p_worksheet = writer.sheets["Fysiek 1p"]
-    fysiek_2p_plus_worksheet = writer.sheets["Fysiek 2p+"]
-    fysiek_2p_plus_brieven_worksheet = writer.sheets["Fysiek 2p+ brieven"]
+def build_sheets(df, specs=SHEETS):
+    """
+    Return the output sheets as (sheet name, DataFrame) pairs in workbook
+    order.
+    """
+    return [(spec.name, build_sheet(df, spec)) for spec in specs]
+
+
+def available_reader_engines():
+    engines = []
+    for engine in READER_ENGINES:
+        module = "python_calamine" if engine == "calamine" else engine
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        engines.append(engine)
+    return engines
+
+
+def _source_file(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return BytesIO(source)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return source
+
+
+def _first_sheet_path(archive):
+    workbook = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+    sheet = workbook.find(f"{_MAIN_NS}sheets/{_MAIN_NS}sheet")
+    rel_id = sheet.get(f"{_REL_NS}id")
+    rels = ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels.iter(f"{_PACKAGE_REL_NS}Relationship"):
+        if rel.get("Id") == rel_id:
+            target = rel.get("Target")
+            if target.startswith("/"):
+                return target.lstrip("/")
+            return posixpath.normpath(posixpath.join("xl", target))
+    raise ValueError("Workbook has no worksheet")
+
+
+def _column_index(reference):
+    index = 0
+    for char in reference:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - ord("A") + 1
+    return index - 1
+
+
+def _sheet_rows(archive, limit):
+    """
+    The first ``limit`` rows of the first sheet, streamed from the XML: per
+    row a dict of column index to (cell type, value). Shared strings are
+    left as their position in the shared string table (type "s").
+    """
+    rows, cells = [], {}
+    with archive.open(_first_sheet_path(archive)) as sheet:
+        for _, element in ElementTree.iterparse(sheet):
+            if element.tag == f"{_MAIN_NS}c":
+                reference = element.get("r")
+                index = _column_index(reference) if reference else len(cells)
+                if element.get("t") == "inlineStr":
+                    value = "".join(t.text or "" for t in element.iter(f"{_MAIN_NS}t"))
+                else:
+                    value = element.findtext(f"{_MAIN_NS}v")
+                cells[index] = (element.get("t"), value)
+            elif element.tag == f"{_MAIN_NS}row":
+                rows.append(cells)
+                cells = {}
+                element.clear()
+                if len(rows) >= limit:
+                    break
+    return rows
+
+
+def _shared_strings(archive, cells):
+    """
+    Resolve the shared strings among ``cells`` ((type, value) pairs) to
+    their text, reading the shared string table only up to the last one.
+    """
+    shared = {int(value) for kind, value in cells if kind == "s"}
+    strings = {}
+    if shared and "xl/sharedStrings.xml" in archive.namelist():
+        with archive.open("xl/sharedStrings.xml") as table:
+            position = 0
+            for _, element in ElementTree.iterparse(table):
+                if element.tag == f"{_MAIN_NS}si":
+                    if position in shared:
+                        strings[position] = "".join(
+                            t.text or "" for t in element.iter(f"{_MAIN_NS}t")
+                        )
+                    position += 1
+                    element.clear()
+                    if position > max(shared):
+                        break
+    return [
+        (kind, strings.get(int(value)) if kind == "s" else value) for kind, value in cells
+    ]
 
-    digitaal_worksheet = writer.sheets["Digitaal"]
-    digitaal_1p_worksheet = writer.sheets["Digitaal 1p"]
-    digitaal_2p_plus_worksheet = writer.sheets["Digitaal 2p+"]
-    mail_chimp_worksheet = writer.sheets["MailChimp"]
 
-    for i, width in enumerate(get_col_widths(mail_chimp_df)):
-        mail_chimp_worksheet.set_column(i, i, width + 1)
+def _header(archive, rows):
+    """(column index, name) of every header cell of ``rows`` (see _sheet_rows)."""
+    cells = rows[0] if rows else {}
+    names = _shared_strings(archive, cells.values())
+    return [(index, name) for index, (_, name) in zip(cells, names)]
 
-    for i, width in enumerate(get_col_widths(df)):
-        main_worksheet.set_column(i, i, width + 1)
 
-    for i, width in enumerate(get_col_widths(fysiek_df)):
-        fysiek_worksheet.set_column(i, i, width + 1)
+def read_header(source):
+    """
+    Return the header row of the first sheet by streaming the xlsx XML, so
+    neither the sheet nor the full shared string table is loaded.
+    """
+    with zipfile.ZipFile(_source_file(source)) as archive:
+        cells = _header(archive, _sheet_rows(archive, 1))
+    header = [None] * (max(index for index, _ in cells) + 1 if cells else 0)
+    for index, name in cells:
+        header[index] = name
+    return header
+
+
+def _check_cell(column, kind, value):
+    """The type problem of one sampled cell of ``column``, if any."""
+    if value is None or kind in ("s", "str", "inlineStr") and not value.strip():
+        return None
+    if kind == "e":
+        return f"contains the error {value}"
+    if column in NUMBER_COLUMNS and kind in ("s", "str", "inlineStr", "d"):
+        return f"should hold numbers, found {value!r}"
+    if column in DATE_COLUMNS and kind in ("s", "str", "inlineStr"):
+        try:
+            pd.to_datetime(value)
+        except (ValueError, OverflowError):
+            return f"should hold dates, found {value!r}"
+    return None
+
+
+def check_source(source, sample_rows=SCHEMA_SAMPLE_ROWS):
+    """
+    Check that ``source`` is a workbook with the SOURCE_COLUMNS in the header
+    of its first sheet, and that the first ``sample_rows`` rows hold numbers
+    in the NUMBER_COLUMNS and dates in the DATE_COLUMNS. Only the header and
+    the sample are read, so a bad upload is refused before it is processed.
+    Raises ValueError describing the problems.
+    """
+    try:
+        with zipfile.ZipFile(_source_file(source)) as archive:
+            rows = _sheet_rows(archive, sample_rows + 1)
+            # Matched like read_source names the columns of the frame
+            positions = {}
+            for index, name in sorted(_header(archive, rows)):
+                if name is not None:
+                    positions.setdefault(str(name).lower(), []).append(index)
+            checked = [
+                (column, positions[column][0])
+                for column in NUMBER_COLUMNS + DATE_COLUMNS
+                if len(positions.get(column, ())) == 1
+            ]
+            # Only the shared strings of the checked columns are looked up
+            samples = {
+                column: _shared_strings(
+                    archive, [row.get(index, (None, None)) for row in rows[1:]]
+                )
+                for column, index in checked
+            }
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        raise ValueError(f"Not a readable .xlsx workbook: {e}")
+
+    problems = []
+    missing = [column for column in SOURCE_COLUMNS if column not in positions]
+    if missing:
+        problems.append(f"missing column(s): {', '.join(missing)}")
+    duplicate = [column for column in SOURCE_COLUMNS if len(positions.get(column, ())) > 1]
+    if duplicate:
+        problems.append(f"duplicate column(s): {', '.join(duplicate)}")
+    for column, cells in samples.items():
+        for number, cell in enumerate(cells, start=2):
+            problem = _check_cell(column, *cell)
+            if problem is not None:
+                problems.append(f"column {column!r} {problem} (row {number})")
+                break
+    if problems:
+        raise ValueError("Bron.xlsx does not match the expected layout: " + "; ".join(problems))
+
+
+def count_rows(source):
+    """
+    Number of data rows below the header of the first sheet, from the sheet's
+    <dimension> element, which precedes the cells; None when the workbook
+    does not declare it.
+    """
+    with zipfile.ZipFile(_source_file(source)) as archive:
+        with archive.open(_first_sheet_path(archive)) as sheet:
+            for _, element in ElementTree.iterparse(sheet, events=("start",)):
+                if element.tag == f"{_MAIN_NS}dimension":
+                    last = element.get("ref", "").rpartition(":")[2]
+                    digits = last.upper().lstrip("$ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+                    return max(int(digits) - 1, 0) if digits.isdigit() else None
+                if element.tag == f"{_MAIN_NS}sheetData":
+                    return None
+    return None
+
+
+def read_source(source, engine=None, columns=None):
+    """
+    Read the first sheet of a Bron.xlsx path, bytes or file object into a
+    DataFrame with lowercased column names.
+
+    The requested engine (default READER_ENGINE) is tried first and the other
+    available engines serve as fallback. Text columns are parsed as strings
+    and, when ``columns`` is given, only those columns are parsed at all.
+    Returns the frame and a timing dict with the engine that was used and
+    the seconds it took.
+    """
+    engine = engine or READER_ENGINE
+    available = available_reader_engines()
+    candidates = [engine] if engine in available else []
+    candidates += [candidate for candidate in available if candidate not in candidates]
+
+    started = time.perf_counter()
+    header = [name for name in read_header(source) if name is not None]
+    dtype = {name: str for name in header if name.strip().lower() in TEXT_COLUMNS}
+    usecols = None
+    if columns is not None:
+        wanted = {column.lower() for column in columns}
+        usecols = [name for name in header if name.strip().lower() in wanted]
+
+    failed = []
+    for candidate in candidates:
+        try:
+            df = pd.read_excel(
+                _source_file(source), engine=candidate, usecols=usecols, dtype=dtype
+            )
+        except Exception:
+            if candidate == candidates[-1]:
+                raise
+            failed.append(candidate)
+            continue
+        df.columns = df.columns.str.lower()
+        timing = {
+            "engine": candidate,
+            "seconds": time.perf_counter() - started,
+            "rows": len(df),
+            "fallback_from": failed,
+        }
+        return df, timing
+    raise ValueError(f"No xlsx reader engine available (requested {engine!r})")
+
+
+def compare_reader_engines(source, columns=None):
+    """
+    Read ``source`` once with every available engine and return the seconds
+    each one took, to compare engines on a real upload.
+    """
+    return {
+        engine: read_source(source, engine=engine, columns=columns)[1]["seconds"]
+        for engine in available_reader_engines()
+    }
 
-    for i, width in enumerate(get_col_widths(fysiek_1p_df)):
-        fysiek_1p_worksheet.set_column(i, i, width + 1)
 
-    for i, width in enumerate(get_col_widths(fysiek_2p_plus_df)):
-        fysiek_2p_plus_worksheet.set_column(i, i, width + 1)
+@dataclass
+class Grouping:
+    """
+    Rows grouped by one key column: the factorized group code of every row
+    and the number of rows per group. Missing keys form a group of their own,
+    as with DataFrame.duplicated.
+    """
 
-    for i, width in enumerate(get_col_widths(fysiek_2p_plus_brieven_df)):
-        fysiek_2p_plus_brieven_worksheet.set_column(i, i, width + 1)
+    codes: np.ndarray
+    sizes: np.ndarray
 
-    for i, width in enumerate(get_col_widths(digitaal_df)):
-        digitaal_worksheet.set_column(i, i, width + 1)
+    @classmethod
+    def of(cls, values):
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        return cls(codes, np.bincount(codes, minlength=len(uniques)))
 
-    for i, width in enumerate(get_col_widths(digitaal_1p_df)):
-        digitaal_1p_worksheet.set_column(i, i, width + 1)
+    def shared(self):
+        """Mask of the rows whose key occurs more than once."""
+        return self.sizes[self.codes] > 1
 
-    for i, width in enumerate(get_col_widths(digitaal_2p_plus_df)):
-        digitaal_2p_plus_worksheet.set_column(i, i, width + 1)
 
-    writer.close()
+@dataclass
+class HouseholdIndex:
+    """
+    The address, email and contract groupings, computed once per run. Only
+    the groupings the given CLASSIFICATION_STEPS use are built; the others
+    are None.
+    """
 
-    print("File processed and saved successfully with additional sheets.")
+    address: Optional[Grouping]
+    email: Optional[Grouping]
+    contract: Optional[Grouping]
+
+    @classmethod
+    def build(cls, df, steps=CLASSIFICATION_STEPS):
+        fysiek = "fysiek" in steps or "letters" in steps
+        digitaal = "digitaal" in steps or "families" in steps
+        return cls(
+            address=Grouping.of(df["postcode huisnummer toevoeging"]) if fysiek else None,
+            email=Grouping.of(df["email"]) if digitaal else None,
+            contract=Grouping.of(df["contractnummer"]) if "letters" in steps else None,
+        )
 
 
-def get_col_widths(dataframe):
-    return [
-        max([len(str(s)) for s in dataframe[col].values] + [len(col)])
-        for col in dataframe.columns
-    ]
+def _first_per_group(codes):
+    """Positions in ``codes`` of the first occurrence of every group."""
+    return np.unique(codes, return_index=True)[1]
 
 
-def process_excel_bytes(input_bytes: bytes) -> bytes:
+def select_letter_recipients(df, contracts, workers=None):
     """
-    Read an Excel file from bytes, apply the transformations, and return the
-    resulting Excel workbook as bytes.
+    Pick the "fysiek 2p+ brieven" row of every contract: the first row with
+    toorts == 1, otherwise the oldest member when nobody in the contract has
+    a toorts flag. ``contracts`` is the contractnummer Grouping of ``df``;
+    see classify_sharded for ``workers``.
     """
-    input_buffer = BytesIO(input_bytes)
-    df = pd.read_excel(input_buffer).fillna(0)
-    df.columns = df.columns.str.lower()
-    df["land"] = df["land"].replace("Nederland", "")
-    df["email"] = df["email"].str.lower()
-    df["postcode"] = df["postcode"].astype(str)
-
-    df.insert(0, "card", 2)
-    df.insert(0, "fam", np.nan)
-    df.insert(0, "naam compleet", np.nan)
-    df.insert(0, "straat compleet", np.nan)
-    df.insert(0, "plaats compleet", np.nan)
-    df.insert(0, "name", np.nan)
-    df.insert(0, "MailChimp", False)
-    df.insert(0, "fam_number", 0)
-    df.insert(0, "digitaal 2p+ family", False)
-    df.insert(0, "digitaal 2p+", False)
-    df.insert(0, "digitaal 1p", False)
-    df.insert(0, "digitaal", False)
-    df.insert(0, "fysiek 2p+ brieven", False)
-    df.insert(0, "fysiek 2p+", False)
-    df.insert(0, "fysiek 1p", False)
-    df.insert(0, "fysiek", False)
-
-    df["name"] = (
-        df["tussenvoegsel"].replace(0, "").apply(lambda x: x.strip() + " " if x.strip() != "" else "")
-        + df["naam"]
+    (selected,) = classify_sharded(
+        _letter_recipients,
+        {
+            "codes": contracts.codes,
+            "candidates": df["fysiek 2p+"].to_numpy(),
+            "toorts": df["toorts"].to_numpy(),
+            "birth": df["geboortedatum"].to_numpy(),
+        },
+        len(contracts.sizes),
+        (bool,),
+        workers,
     )
-    df["naam compleet"] = (
-        df["voornaam"]
-        + df["tussenvoegsel"].replace(0, "").apply(lambda x: " " + x if x.strip() != "" else "")
-        + " "
-        + df["naam"]
-    )
-    df["straat compleet"] = (
-        df["straat"]
-        + " "
-        + df["huisnummer"].astype(str)
-        + df["toevoeging"].replace(0, "").replace("", "").apply(lambda x: " " + x if x.strip() != "" else "")
-    )
-    df["plaats compleet"] = df["postcode"] + "  " + df["plaats"]
-    df["postcode huisnummer toevoeging"] = (
-        df["postcode"]
-        + " "
-        + df["huisnummer"].astype(str)
-        + df["toevoeging"].replace(0, "").replace("", "").apply(lambda x: " " + x if x.strip() != "" else "")
-    )
-    df["fam"] = df["naam compleet"] + " " + df["abonneenummer"].astype(str)
-    df["geboortedatum"] = pd.to_datetime(df["geboortedatum"]).dt.strftime("%d-%m-%Y")
-    df["vanaf"] = pd.to_datetime(df["vanaf"]).dt.strftime("%d-%m-%Y")
-
-    address_unique = ~df.duplicated(subset=["postcode huisnummer toevoeging"], keep=False)
-    address_duplicate = df.duplicated(subset=["postcode huisnummer toevoeging"], keep=False)
+    return selected
 
-    df["fysiek"] = df["pas fysiek"] == "Ja"
-    df["fysiek 1p"] = address_unique & (df["pas fysiek"] == "Ja")
-    df["fysiek 2p+"] = address_duplicate & (df["pas fysiek"] == "Ja")
 
-    filtered_df = df[df["fysiek 2p+"]]
-    unique_contracts = filtered_df["contractnummer"].unique()
+def _letter_recipients(codes, candidates, toorts, birth, groups):
+    candidates = np.flatnonzero(candidates)
+    toorts = toorts[candidates]
+    candidate_codes = codes[candidates]
 
-    for contract in unique_contracts:
-        subset = filtered_df[filtered_df["contractnummer"] == contract]
-        if (subset["toorts"] == 1).any():
-            first_toorts = subset[subset["toorts"] == 1].index[0]
-            df.loc[first_toorts, "fysiek 2p+ brieven"] = True
-        else:
-            if (subset["toorts"] == 0).all():
-                oldest = subset[subset["geboortedatum"] == subset["geboortedatum"].min()].index[0]
-                df.loc[oldest, "fysiek 2p+ brieven"] = True
+    with_toorts = toorts == 1
+    first_toorts = candidates[with_toorts][_first_per_group(candidate_codes[with_toorts])]
 
-    df["digitaal"] = df["pas digitaal"] == "Ja"
-    df["digitaal 1p"] = df["digitaal"] & ~df["email"].duplicated(keep=False)
-    df["digitaal 2p+"] = df["digitaal"] & df["email"].duplicated(keep=False)
+    flagged = np.zeros(groups, dtype=bool)
+    flagged[candidate_codes[toorts != 0]] = True
+    no_toorts = ~flagged[candidate_codes]
+    rows, row_codes = candidates[no_toorts], candidate_codes[no_toorts]
+    # lexsort is stable: equal birth dates keep their row order
+    by_age = np.lexsort((birth[rows], row_codes))
+    oldest = rows[by_age][_first_per_group(row_codes[by_age])]
 
-    digital_2p_plus_df = df[df["digitaal 2p+"]]
-    unique_emails = digital_2p_plus_df["email"].unique()
+    selected = np.zeros(len(codes), dtype=bool)
+    selected[first_toorts] = True
+    selected[oldest] = True
+    return (selected,)
 
-    for email in unique_emails:
-        subset = digital_2p_plus_df[digital_2p_plus_df["email"] == email]
-        if (subset["toorts"] == 1).any():
-            main_row_index = subset[subset["toorts"] == 1].index[0]
-        else:
-            main_row_index = subset["geboortedatum"].idxmin()
-        df.loc[main_row_index, "MailChimp"] = True
-        joining_rows = subset.index.difference([main_row_index])
-        df.loc[joining_rows, "MailChimp"] = False
-
-    df.loc[df["digitaal 1p"], "MailChimp"] = True
-
-    digital_2p_plus_family_df = df[df["digitaal 2p+"]].copy()
-    unique_emails_digital_family = digital_2p_plus_family_df["email"].unique()
-
-    for email in unique_emails_digital_family:
-        subset = digital_2p_plus_family_df[digital_2p_plus_family_df["email"] == email]
-        if (subset["toorts"] == 1).any():
-            main_row_index = subset[subset["toorts"] == 1].index[0]
-            main_email = subset.loc[main_row_index, "email"]
-            matching_emails_indices = subset[(subset["email"] == main_email) & (subset.index != main_row_index)].index
-            df.loc[matching_emails_indices, "digitaal 2p+ family"] = True
-            family_subset = subset[subset["email"] != main_email]
-            if not family_subset.empty:
-                oldest_family_member_index = family_subset["geboortedatum"].idxmin()
-                df.loc[oldest_family_member_index, "digitaal 2p+ family"] = False
-                remaining_family_indices = family_subset.index.difference([oldest_family_member_index])
-                df.loc[remaining_family_indices, "digitaal 2p+ family"] = True
-        else:
-            main_row_index = subset["geboortedatum"].idxmin()
-            main_email = subset.loc[main_row_index, "email"]
-            matching_emails_indices = subset[(subset["email"] == main_email) & (subset.index != main_row_index)].index
-            df.loc[matching_emails_indices, "digitaal 2p+ family"] = True
-
-    digitaal_2p_plus_family_df = df[df["digitaal 2p+ family"]].copy()
-    unique_contracts = digitaal_2p_plus_family_df["email"].unique()
-
-    for contract in unique_contracts:
-        subset = digitaal_2p_plus_family_df[digitaal_2p_plus_family_df["email"] == contract]
-        subset["geboortedatum"] = pd.to_datetime(subset["geboortedatum"], format="%d-%m-%Y")
-        subset_sorted = subset.sort_values(by="geboortedatum")
-
-        for i, idx in enumerate(subset_sorted.index):
-            df.at[idx, "fam_number"] = i + 1
-
-    fysiek_columns = {
-        "Naam compleet": "naam compleet",
-        "Geboortedatum": "geboortedatum",
-        "Straat compleet": "straat compleet",
-        "Plaats compleet": "plaats compleet",
-        "Land": "land",
-        "Vanaf": "vanaf",
-        "Abonneenummer": "abonneenummer",
-        "toorts": "toorts",
-    }
 
-    fysiek_data = df[df["fysiek"]].copy()
-    fysiek_df = fysiek_data[list(fysiek_columns.values())]
-    fysiek_df.columns = list(fysiek_columns.keys())
-
-    fysiek_1p_data = df[df["fysiek 1p"]].copy()
-    fysiek_1p_df = fysiek_1p_data[list(fysiek_columns.values())]
-    fysiek_1p_df.columns = list(fysiek_columns.keys())
-
-    fysiek_2p_plus_data = df[df["fysiek 2p+"]].copy()
-    fysiek_2p_plus_df = fysiek_2p_plus_data[list(fysiek_columns.values())]
-    fysiek_2p_plus_df.columns = list(fysiek_columns.keys())
-
-    fysiek_2p_plus_brieven_data = df[df["fysiek 2p+ brieven"]].copy()
-    fysiek_2p_plus_brieven_df = fysiek_2p_plus_brieven_data[list(fysiek_columns.values())]
-    fysiek_2p_plus_brieven_df.columns = list(fysiek_columns.keys())
-
-    digitaal_columns = {
-        "contractnummer": "contractnummer",
-        "cardNumber": "abonneenummer",
-        "name": "naam compleet",
-        "birthday": "geboortedatum",
-        "email": "email",
-        "dynamicField": "vanaf",
-        "card": "card",
-    }
+def classify_households(df, emails, workers=None):
+    """
+    Classify the "digitaal 2p+" rows that share an email address. Per address
+    the main row is the first row with toorts == 1, otherwise the oldest
+    member; every other row is a family member, numbered from oldest to
+    youngest. ``emails`` is the email Grouping of ``df``; see
+    classify_sharded for ``workers``.
+
+    Returns the main-row mask, the family mask and the fam_number array, all
+    aligned with ``df``.
+    """
+    return classify_sharded(
+        _households,
+        {
+            "codes": emails.codes,
+            # Rows without an email address do not form a household
+            "members": df["digitaal 2p+"].to_numpy() & df["email"].notna().to_numpy(),
+            "toorts": df["toorts"].to_numpy(),
+            "birth": df["geboortedatum"].to_numpy(),
+        },
+        len(emails.sizes),
+        (bool, bool, int),
+        workers,
+    )
 
-    digitaal_data = df[df["digitaal"]].copy()
-    digitaal_df = digitaal_data[list(digitaal_columns.values())]
-    digitaal_df.columns = list(digitaal_columns.keys())
-
-    digitaal_1p_data = df[df["digitaal 1p"]].copy()
-    digitaal_1p_df = digitaal_1p_data[list(digitaal_columns.values())]
-    digitaal_1p_df.columns = list(digitaal_columns.keys())
-
-    digitaal_2p_plus_data = df[(df["digitaal 2p+"] == True) & (df["digitaal 2p+ family"] == False)].copy()
-    digitaal_2p_plus_df = digitaal_2p_plus_data[list(digitaal_columns.values())]
-    digitaal_2p_plus_df.columns = list(digitaal_columns.keys())
-
-    digitaal_2p_plus_df["fam1"] = ""
-    digitaal_2p_plus_df["fam2"] = ""
-    digitaal_2p_plus_df["fam3"] = ""
-    digitaal_2p_plus_df["fam4"] = ""
-    digitaal_2p_plus_df.loc[:, ["fam1", "fam2", "fam3", "fam4"]] = digitaal_2p_plus_df[["fam1", "fam2", "fam3", "fam4"]].astype(str)
-
-    family_true_df = df[df["digitaal 2p+ family"] == True]
-
-    for idx, row in family_true_df.iterrows():
-        fam_number = row["fam_number"]
-        if fam_number in [1, 2, 3, 4]:
-            fam_column = f"fam{int(fam_number)}"
-            matching_email_rows = digitaal_2p_plus_df["email"] == row["email"]
-            digitaal_2p_plus_df.loc[matching_email_rows, fam_column] = row["fam"]
-
-    mail_chimp_columns = {
-        "Email Address": "email",
-        "First": "voornaam",
-        "Name": "name",
-        "Lidmaatschapsnummer": "abonneenummer",
-    }
 
-    mail_chimp_data = df[df["MailChimp"]].copy()
-    mail_chimp_df = mail_chimp_data[list(mail_chimp_columns.values())]
-    mail_chimp_df.columns = list(mail_chimp_columns.keys())
-    mail_chimp_df = mail_chimp_df.drop_duplicates(subset=["Email Address"])
+def _households(codes, members, toorts, birth, groups):
+    members = np.flatnonzero(members)
+    ranked = members[np.lexsort((birth[members], codes[members]))]
+    ranked_codes = codes[ranked]
+
+    toorts_rows = members[toorts[members] == 1]
+    toorts_codes = codes[toorts_rows]
+    has_toorts = np.zeros(groups, dtype=bool)
+    has_toorts[toorts_codes] = True
+    without_toorts = ranked[~has_toorts[ranked_codes]]
+
+    main = np.zeros(len(codes), dtype=bool)
+    main[toorts_rows[_first_per_group(toorts_codes)]] = True
+    main[without_toorts[_first_per_group(codes[without_toorts])]] = True
+
+    # Family rows are ordered by household, then age; number them per run
+    family_rows = ranked[~main[ranked]]
+    family_codes = codes[family_rows]
+    positions = np.arange(len(family_rows))
+    run_starts = np.r_[True, family_codes[1:] != family_codes[:-1]]
+    first_of_run = np.maximum.accumulate(np.where(run_starts, positions, 0))
+    fam_number = np.zeros(len(codes), dtype=int)
+    fam_number[family_rows] = positions - first_of_run + 1
+
+    family = np.zeros(len(codes), dtype=bool)
+    family[family_rows] = True
+    return main, family, fam_number
+
+
+# (workers, executor) of the pool classify_sharded runs on, started on first use
+_classify_pool = None
+
+
+def _classify_executor(workers):
+    global _classify_pool
+    if _classify_pool is None or _classify_pool[0] != workers:
+        if _classify_pool is not None:
+            _classify_pool[1].shutdown()
+        # spawn: the pipeline also runs in processes with threads (uvicorn)
+        context = get_context("spawn")
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        # A pool worker (JobManager) joins its children before atexit would
+        # shut this pool down. A finalizer runs before that join, and ahead
+        # of the finalizers (priority 10) closing the pool's own queues.
+        util.Finalize(executor, executor.shutdown, exitpriority=20)
+        _classify_pool = workers, executor
+    return _classify_pool[1]
+
+
+def classify_sharded(kernel, inputs, groups, outputs, workers=None):
+    """
+    Run a classification ``kernel`` over the row-aligned ``inputs`` arrays,
+    whose "codes" are the household key of every row (``groups`` keys in
+    all), and return its ``outputs`` (one dtype per returned array).
+
+    With more than one of ``workers`` (default CLASSIFY_WORKERS) the rows are
+    sharded by key over a process pool. Every key lands in one shard and
+    the rows of a shard keep their order, so each shard classifies its
+    households exactly as the whole frame would: the merged result is
+    identical to the serial one. Inputs and outputs are passed in shared
+    memory rather than pickled.
+    """
+    if workers is None:
+        workers = CLASSIFY_WORKERS
+    if workers <= 1 or any(array.dtype.hasobject for array in inputs.values()):
+        return kernel(groups=groups, **inputs)
 
-    output_buffer = BytesIO()
-    writer = pd.ExcelWriter(output_buffer, engine="xlsxwriter")
-    df.to_excel(writer, index=False, sheet_name="Main")
+    rows = len(inputs["codes"])
+    blocks = []
+    try:
+        input_specs = {}
+        for name, array in inputs.items():
+            input_specs[name] = _share(blocks, array.dtype, rows)
+            _attach(blocks[-1], input_specs[name])[:] = array
+        output_specs = [_share(blocks, np.dtype(dtype), rows) for dtype in outputs]
+        executor = _classify_executor(workers)
+        shards = [
+            executor.submit(
+                _classify_shard, kernel, input_specs, output_specs, groups, shard, workers
+            )
+            for shard in range(workers)
+        ]
+        for shard in shards:
+            shard.result()
+        return tuple(
+            _attach(block, spec).copy()
+            for block, spec in zip(blocks[len(inputs):], output_specs)
+        )
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
 
-    fysiek_df.to_excel(writer, index=False, sheet_name="Fysiek")
-    fysiek_1p_df.to_excel(writer, index=False, sheet_name="Fysiek 1p")
-    fysiek_2p_plus_df.to_excel(writer, index=False, sheet_name="Fysiek 2p+")
-    fysiek_2p_plus_brieven_df.to_excel(writer, index=False, sheet_name="Fysiek 2p+ brieven")
 
-    digitaal_df.drop(columns=["contractnummer"], inplace=True)
-    digitaal_df.to_excel(writer, index=False, sheet_name="Digitaal")
+def _share(blocks, dtype, rows):
+    block = shared_memory.SharedMemory(create=True, size=max(dtype.itemsize * rows, 1))
+    blocks.append(block)
+    return block.name, dtype.str, rows
 
-    digitaal_1p_df.drop(columns=["contractnummer"], inplace=True)
-    digitaal_1p_df.to_excel(writer, index=False, sheet_name="Digitaal 1p")
 
-    digitaal_2p_plus_df.drop(columns=["contractnummer"], inplace=True)
-    digitaal_2p_plus_df.to_excel(writer, index=False, sheet_name="Digitaal 2p+")
+def _attach(block, spec):
+    _, dtype, rows = spec
+    return np.ndarray((rows,), dtype=dtype, buffer=block.buf)
 
-    mail_chimp_df.to_excel(writer, index=False, sheet_name="MailChimp")
 
-    workbook = writer.book
-    main_worksheet = writer.sheets["Main"]
+def _classify_shard(kernel, input_specs, output_specs, groups, shard, shards):
+    blocks = [shared_memory.SharedMemory(name=spec[0]) for spec in input_specs.values()]
+    blocks += [shared_memory.SharedMemory(name=spec[0]) for spec in output_specs]
+    arrays = {}
+    try:
+        for block, (name, spec) in zip(blocks, input_specs.items()):
+            arrays[name] = _attach(block, spec)
+        rows = np.flatnonzero(arrays["codes"] % shards == shard)
+        results = kernel(groups=groups, **{name: array[rows] for name, array in arrays.items()})
+        for block, spec, result in zip(blocks[len(input_specs):], output_specs, results):
+            _attach(block, spec)[rows] = result
+    finally:
+        # The views must go before their blocks can be closed
+        arrays.clear()
+        for block in blocks:
+            block.close()
+
+
+def build_family_slots(df, emails, slots=None):
+    """
+    Pivot the family members of every household into fam1..fam<slots>
+    columns by (email, fam_number) and return them aligned with ``emails``.
+    Households with more members than slots keep the oldest ones.
+    """
+    if slots is None:
+        slots = MAX_FAMILY_SLOTS
+    columns = [f"fam{number}" for number in range(1, slots + 1)]
+    members = df.loc[
+        df["digitaal 2p+ family"] & df["fam_number"].between(1, slots),
+        ["email", "fam_number", "fam"],
+    ]
+    table = members.pivot(index="email", columns="fam_number", values="fam")
+    table.columns = [f"fam{int(number)}" for number in table.columns]
+    slots_df = table.reindex(index=emails.to_numpy(), columns=columns).fillna("")
+    slots_df.index = emails.index
+    return slots_df
 
-    fysiek_worksheet = writer.sheets["Fysiek"]
-    fysiek_1p_worksheet = writer.sheets["Fysiek 1p"]
-    fysiek_2p_plus_worksheet = writer.sheets["Fysiek 2p+"]
-    fysiek_2p_plus_brieven_worksheet = writer.sheets["Fysiek 2p+ brieven"]
 
-    digitaal_worksheet = writer.sheets["Digitaal"]
-    digitaal_1p_worksheet = writer.sheets["Digitaal 1p"]
-    digitaal_2p_plus_worksheet = writer.sheets["Digitaal 2p+"]
-    mail_chimp_worksheet = writer.sheets["MailChimp"]
+def date_only_columns(frame):
+    """Names of the datetime64 columns of ``frame`` that hold no time of day."""
+    columns = []
+    for col, dtype in frame.dtypes.items():
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            values = frame[col].dropna()
+            if (values == values.dt.normalize()).all():
+                columns.append(col)
+    return columns
 
-    for i, width in enumerate(get_col_widths(mail_chimp_df)):
-        mail_chimp_worksheet.set_column(i, i, width + 1)
 
-    for i, width in enumerate(get_col_widths(df)):
-        main_worksheet.set_column(i, i, width + 1)
+def get_col_widths(dataframe, sample=None):
+    """
+    Return the width of every column: the longest str() of its values or of
+    its header. Lengths are computed with NumPy string kernels; datetime
+    columns are as wide as their DATE_FORMAT or DATETIME_FORMAT. With
+    ``sample`` (default COL_WIDTH_SAMPLE) set, only that many evenly spaced
+    rows are measured.
+    """
+    if sample is None:
+        sample = COL_WIDTH_SAMPLE
+    if sample and len(dataframe) > sample:
+        dataframe = dataframe.iloc[np.linspace(0, len(dataframe) - 1, sample).astype(int)]
+    dates = date_only_columns(dataframe)
+    widths = []
+    for col, dtype in dataframe.dtypes.items():
+        if col in dates:
+            longest = len(DATE_FORMAT)
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            longest = len(DATETIME_FORMAT)
+        else:
+            # Missing values are written as empty cells
+            values = dataframe[col].dropna().to_numpy()
+            longest = int(np.char.str_len(values.astype(str)).max()) if len(values) else 0
+        widths.append(max(longest, len(col)))
+    return widths
 
-    for i, width in enumerate(get_col_widths(fysiek_df)):
-        fysiek_worksheet.set_column(i, i, width + 1)
 
-    for i, width in enumerate(get_col_widths(fysiek_1p_df)):
-        fysiek_1p_worksheet.set_column(i, i, width + 1)
+def _report_sheet(progress, number, sheets, name, written=0):
+    if progress is not None:
+        progress("write", sheet=number, sheets=sheets, name=name, written=written)
 
-    for i, width in enumerate(get_col_widths(fysiek_2p_plus_df)):
-        fysiek_2p_plus_worksheet.set_column(i, i, width + 1)
 
-    for i, width in enumerate(get_col_widths(fysiek_2p_plus_brieven_df)):
-        fysiek_2p_plus_brieven_worksheet.set_column(i, i, width + 1)
+def write_workbook(sheets, target, mode=None, timings=None, progress=None):
+    """
+    Write (sheet name, DataFrame) pairs to ``target``, a path or binary file
+    object, with column widths fitted to the contents.
+
+    The "streaming" mode writes rows one by one through xlsxwriter's
+    constant_memory mode, so only the current row of every sheet is held in
+    memory. The "pandas" mode goes through DataFrame.to_excel. Dates without
+    a time of day are written as date cells in DATE_FORMAT. Seconds spent
+    on the "widths" and "write" stages are added to ``timings`` and every
+    sheet is reported to ``progress`` before it is written, when given.
+    """
+    mode = mode or WRITER_MODE
+    with timed(timings, "widths", progress):
+        widths = [get_col_widths(frame) for _, frame in sheets]
+
+    with timed(timings, "write"):
+        if mode == "pandas":
+            with pd.ExcelWriter(
+                target,
+                engine="xlsxwriter",
+                date_format=DATE_FORMAT,
+                datetime_format=DATETIME_FORMAT,
+            ) as writer:
+                for number, ((name, frame), sheet_widths) in enumerate(zip(sheets, widths), 1):
+                    _report_sheet(progress, number, len(sheets), name)
+                    # pandas applies date_format to date objects only
+                    dates = {col: frame[col].dt.date for col in date_only_columns(frame)}
+                    frame = frame.assign(**dates)
+                    frame.to_excel(writer, index=False, sheet_name=name)
+                    worksheet = writer.sheets[name]
+                    for i, width in enumerate(sheet_widths):
+                        worksheet.set_column(i, i, width + 1)
+            return
+
+        workbook = xlsxwriter.Workbook(target, {"constant_memory": True})
+        try:
+            datetime_format = workbook.add_format({"num_format": DATETIME_FORMAT})
+            date_format = workbook.add_format({"num_format": DATE_FORMAT})
+            for number, ((name, frame), sheet_widths) in enumerate(zip(sheets, widths), 1):
+                _report_sheet(progress, number, len(sheets), name)
+                dates = set(date_only_columns(frame))
+                formats = [date_format if col in dates else datetime_format for col in frame.columns]
+                worksheet = workbook.add_worksheet(name)
+                for i, width in enumerate(sheet_widths):
+                    worksheet.set_column(i, i, width + 1)
+                worksheet.write_row(0, 0, list(frame.columns))
+                rows = frame.itertuples(index=False, name=None)
+                for row, values in enumerate(rows, start=1):
+                    if row % PROGRESS_ROWS == 0:
+                        _report_sheet(progress, number, len(sheets), name, row)
+                    for col, value in enumerate(values):
+                        # Missing values stay empty cells, as with DataFrame.to_excel
+                        if value is None or value is pd.NA or value != value:
+                            continue
+                        if isinstance(value, datetime.datetime):
+                            worksheet.write_datetime(row, col, value, formats[col])
+                        elif isinstance(value, datetime.date):
+                            worksheet.write_datetime(row, col, value, date_format)
+                        else:
+                            worksheet.write(row, col, value)
+        finally:
+            workbook.close()
+
+
+def available_output_formats():
+    formats = []
+    for output_format in OUTPUT_FORMATS:
+        if output_format == "parquet":
+            try:
+                __import__("pyarrow")
+            except ImportError:
+                continue
+        formats.append(output_format)
+    return formats
+
+
+def _format_dates(series):
+    """dd-mm-yyyy text of a date-only datetime column, by reordering ISO dates."""
+    iso = series.to_numpy().astype("datetime64[D]").astype("U10")
+    chars = iso.view("U1").reshape(-1, 10)[:, [8, 9, 7, 5, 6, 4, 0, 1, 2, 3]]
+    text = np.ascontiguousarray(chars).view("U10").ravel()
+    return pd.Series(text, index=series.index).where(series.notna())
+
+
+def _export_frame(frame, output_format):
+    # CSV shows dates like the workbook does; Parquet needs one type per
+    # column, so mixed object columns (text with 0 placeholders) become text
+    if output_format == "csv":
+        dates = {col: _format_dates(frame[col]) for col in date_only_columns(frame)}
+        return frame.assign(**dates)
+    mixed = {
+        col: frame[col].astype(str) for col, dtype in frame.dtypes.items() if dtype == object
+    }
+    return frame.assign(**mixed)
 
-    for i, width in enumerate(get_col_widths(digitaal_df)):
-        digitaal_worksheet.set_column(i, i, width + 1)
 
-    for i, width in enumerate(get_col_widths(digitaal_1p_df)):
-        digitaal_1p_worksheet.set_column(i, i, width + 1)
+def write_bundle(sheets, target, output_format, timings=None, progress=None):
+    """
+    Write (sheet name, DataFrame) pairs to ``target``, a path or binary file
+    object, as a zip with a "<sheet name>.csv" or "<sheet name>.parquet" file
+    per sheet. Seconds spent are added to ``timings["write"]`` and every
+    sheet is reported to ``progress``, when given.
+    """
+    if output_format not in available_output_formats():
+        raise ValueError(f"Unsupported output format: {output_format}")
+    # Parquet files are compressed already; CSV gets fast deflate
+    compression = zipfile.ZIP_DEFLATED if output_format == "csv" else zipfile.ZIP_STORED
+    with timed(timings, "write"), zipfile.ZipFile(
+        target, "w", compression, compresslevel=1
+    ) as bundle:
+        for number, (name, frame) in enumerate(sheets, 1):
+            _report_sheet(progress, number, len(sheets), name)
+            frame = _export_frame(frame, output_format)
+            if output_format == "csv":
+                with bundle.open(f"{name}.csv", "w") as member:
+                    frame.to_csv(member, index=False, encoding="utf-8")
+            else:
+                buffer = BytesIO()
+                frame.to_parquet(buffer, index=False)
+                bundle.writestr(f"{name}.parquet", buffer.getvalue())
+
+
+def _source_size(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    return None
+
+
+def process_excel_spooled(
+    source, stats=None, output_format="xlsx", sheets=None, progress=None
+):
+    """
+    Process a Bron.xlsx path, bytes or file object and return the resulting
+    workbook, or with ``output_format`` "csv" or "parquet" a zip of per-sheet
+    files, as a SpooledTemporaryFile positioned at the start. Results larger
+    than SPOOL_MAX_BYTES live on disk instead of in memory.
+
+    ``sheets`` limits the output to those sheet names (see select_sheets);
+    only the classification steps they need run, and without "Main" only
+    the SOURCE_COLUMNS are read.
+
+    When a ``stats`` dict is given it receives the seconds per stage, the
+    reader timing, the row count and the input and output sizes in bytes.
+    ``progress`` is called as ``progress(stage, **info)`` at the start of
+    every stage and sheet (see timed); it may raise to cancel the run.
+    """
+    specs = select_sheets(sheets)
+    # Only the Main sheet shows columns the pipeline does not use
+    columns = None if any(spec.columns is None for spec in specs) else SOURCE_COLUMNS
+    timings = {}
+    with timed(timings, "read", progress):
+        check_source(source)
+        df, reader = read_source(source, columns=columns)
+    df = transform_frame(df, timings, steps=required_steps(specs), progress=progress)
+    with timed(timings, "sheets", progress):
+        sheets = build_sheets(df, specs)
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        if output_format == "xlsx":
+            write_workbook(sheets, output, timings=timings, progress=progress)
+        else:
+            write_bundle(sheets, output, output_format, timings, progress)
+    except BaseException:
+        output.close()
+        raise
+    if stats is not None:
+        stats.update(
+            stages=timings,
+            reader=reader,
+            rows=len(df),
+            input_bytes=_source_size(source),
+            output_bytes=output.tell(),
+        )
+    output.seek(0)
+    return output
 
-    for i, width in enumerate(get_col_widths(digitaal_2p_plus_df)):
-        digitaal_2p_plus_worksheet.set_column(i, i, width + 1)
 
-    writer.close()
-    output_buffer.seek(0)
-    return output_buffer.getvalue()
+def process_excel_bytes(input_bytes: bytes, sheets=None) -> bytes:
+    """
+    Read an Excel file from bytes, apply the transformations, and return the
+    resulting Excel workbook (limited to ``sheets`` when given) as bytes.
+    """
+    with process_excel_spooled(input_bytes, sheets=sheets) as output:
+        return output.read()
@@ -0,0 +1,127 @@
+"""
+The row-by-row classification of the original excel_processor, kept as the
+reference the vectorized pipeline is checked against. It differs from the
+original only where that was broken:
+
+- birth dates are compared as dates instead of as "dd-mm-yyyy" strings;
+- missing text becomes an empty string instead of failing on 0 + str;
+- rows without an email address are skipped instead of failing on an
+  empty household;
+- family members with the same birth date keep their row order.
+"""
+
+import numpy as np
+import pandas as pd
+
+FLAG_COLUMNS = [
+    "fysiek",
+    "fysiek 1p",
+    "fysiek 2p+",
+    "fysiek 2p+ brieven",
+    "digitaal",
+    "digitaal 1p",
+    "digitaal 2p+",
+    "MailChimp",
+    "digitaal 2p+ family",
+    "fam_number",
+]
+DERIVED_COLUMNS = [
+    "name",
+    "naam compleet",
+    "straat compleet",
+    "plaats compleet",
+    "postcode huisnummer toevoeging",
+    "fam",
+]
+FAMILY_SLOTS = ["fam1", "fam2", "fam3", "fam4"]
+
+
+def _text(series):
+    return series.replace(0, "").fillna("")
+
+
+def _suffix(series):
+    return _text(series).apply(lambda x: " " + x if x.strip() != "" else "")
+
+
+def reference_transform(df):
+    """The working frame with the derived columns and classification flags."""
+    df = df.fillna(0)
+    df["land"] = df["land"].replace("Nederland", "")
+    df["email"] = df["email"].str.lower()
+    df["postcode"] = df["postcode"].astype(str)
+
+    for col in FLAG_COLUMNS:
+        df[col] = 0 if col == "fam_number" else False
+
+    df["name"] = (
+        _text(df["tussenvoegsel"]).apply(lambda x: x.strip() + " " if x.strip() != "" else "")
+        + _text(df["naam"])
+    )
+    df["naam compleet"] = (
+        _text(df["voornaam"])
+        + _text(df["tussenvoegsel"]).apply(lambda x: " " + x if x.strip() != "" else "")
+        + " "
+        + _text(df["naam"])
+    )
+    df["straat compleet"] = (
+        _text(df["straat"]) + " " + df["huisnummer"].astype(str) + _suffix(df["toevoeging"])
+    )
+    df["plaats compleet"] = df["postcode"] + "  " + _text(df["plaats"])
+    df["postcode huisnummer toevoeging"] = (
+        df["postcode"] + " " + df["huisnummer"].astype(str) + _suffix(df["toevoeging"])
+    )
+    df["fam"] = df["naam compleet"] + " " + df["abonneenummer"].astype(str)
+    df["geboortedatum"] = pd.to_datetime(df["geboortedatum"])
+
+    address = df.duplicated(subset=["postcode huisnummer toevoeging"], keep=False)
+    df["fysiek"] = df["pas fysiek"] == "Ja"
+    df["fysiek 1p"] = ~address & df["fysiek"]
+    df["fysiek 2p+"] = address & df["fysiek"]
+
+    filtered_df = df[df["fysiek 2p+"]]
+    for contract in filtered_df["contractnummer"].unique():
+        subset = filtered_df[filtered_df["contractnummer"] == contract]
+        if (subset["toorts"] == 1).any():
+            df.loc[subset[subset["toorts"] == 1].index[0], "fysiek 2p+ brieven"] = True
+        elif (subset["toorts"] == 0).all():
+            oldest = subset[subset["geboortedatum"] == subset["geboortedatum"].min()].index[0]
+            df.loc[oldest, "fysiek 2p+ brieven"] = True
+
+    df["digitaal"] = df["pas digitaal"] == "Ja"
+    df["digitaal 1p"] = df["digitaal"] & ~df["email"].duplicated(keep=False)
+    df["digitaal 2p+"] = df["digitaal"] & df["email"].duplicated(keep=False)
+
+    households = df[df["digitaal 2p+"] & df["email"].notna()]
+    for email in households["email"].unique():
+        subset = households[households["email"] == email]
+        if (subset["toorts"] == 1).any():
+            main = subset[subset["toorts"] == 1].index[0]
+        else:
+            main = subset["geboortedatum"].idxmin()
+        df.loc[main, "MailChimp"] = True
+        df.loc[subset.index.difference([main]), "digitaal 2p+ family"] = True
+    df.loc[df["digitaal 1p"], "MailChimp"] = True
+
+    family = df[df["digitaal 2p+ family"]]
+    for email in family["email"].unique():
+        subset = family[family["email"] == email].sort_values("geboortedatum", kind="stable")
+        for number, idx in enumerate(subset.index, start=1):
+            df.at[idx, "fam_number"] = number
+    return df
+
+
+def reference_family_slots(df):
+    """fam1..fam4 of the "Digitaal 2p+" sheet rows of the reference frame."""
+    sheet = df[df["digitaal 2p+"] & ~df["digitaal 2p+ family"]]
+    slots = pd.DataFrame("", index=sheet.index, columns=FAMILY_SLOTS)
+    for _, row in df[df["digitaal 2p+ family"]].iterrows():
+        if row["fam_number"] in [1, 2, 3, 4]:
+            slots.loc[sheet["email"] == row["email"], f"fam{int(row['fam_number'])}"] = row["fam"]
+    return slots
+
+
+def reference_mail_chimp(df):
+    """The abonneenummers on the MailChimp sheet of the reference frame."""
+    rows = df[df["MailChimp"]].drop_duplicates(subset=["email"])
+    return np.asarray(rows["abonneenummer"])
@@ -0,0 +1,174 @@
+import datetime
+import io
+import random
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+import xlsxwriter
+
+import excel_processor
+from benchmarks.generate import HEADER, generate_rows
+from tests.reference import (
+    DERIVED_COLUMNS,
+    FAMILY_SLOTS,
+    FLAG_COLUMNS,
+    reference_family_slots,
+    reference_mail_chimp,
+    reference_transform,
+)
+
+# Positions in benchmarks.generate.HEADER
+NAAM, TOEVOEGING, EMAIL, GEBOORTEDATUM, TOORTS = 4, 7, 11, 12, 14
+
+TIED_BIRTHDAYS = [datetime.datetime(1960, 1, 1), datetime.datetime(1975, 6, 15)]
+SHARED_EMAILS = ["gedeeld@example.nl", "Gedeeld@Example.nl", "club@example.nl"]
+
+
+def write_bron(path, rows):
+    workbook = xlsxwriter.Workbook(str(path))
+    worksheet = workbook.add_worksheet("Leden")
+    date_format = workbook.add_format({"num_format": "dd-mm-yyyy"})
+    worksheet.write_row(0, 0, HEADER)
+    for row, values in enumerate(rows, start=1):
+        for col, value in enumerate(values):
+            if value is None:
+                continue
+            if isinstance(value, datetime.datetime):
+                worksheet.write_datetime(row, col, value, date_format)
+            else:
+                worksheet.write(row, col, value)
+    workbook.close()
+    return path
+
+
+def randomized_rows(seed, rows=400):
+    """
+    Generated members with the cases the rules have to settle: tied and
+    missing birth dates, missing emails, names and toorts flags, several
+    toorts members per household, emails shared across households and
+    numeric toevoegingen.
+    """
+    rng = random.Random(seed)
+    members = [list(row) for row in generate_rows(rows, seed, family_alpha=1.2)]
+    for row in members:
+        if rng.random() < 0.3:
+            row[GEBOORTEDATUM] = rng.choice(TIED_BIRTHDAYS)
+        if rng.random() < 0.05:
+            row[GEBOORTEDATUM] = None
+        if rng.random() < 0.05:
+            row[EMAIL] = None
+        elif rng.random() < 0.05:
+            row[EMAIL] = rng.choice(SHARED_EMAILS)
+        if rng.random() < 0.05:
+            row[NAAM] = None
+        if rng.random() < 0.05:
+            row[TOORTS] = None
+        elif rng.random() < 0.1:
+            row[TOORTS] = 1
+        if rng.random() < 0.05:
+            row[TOEVOEGING] = rng.randint(1, 3)
+    return members
+
+
+def transform(source, workers=1):
+    df, _ = excel_processor.read_source(source)
+    return excel_processor.transform_frame(df, workers=workers)
+
+
+def sheet(df, name):
+    return dict(excel_processor.build_sheets(df, excel_processor.select_sheets([name])))[name]
+
+
+def assert_matches_reference(path):
+    df, _ = excel_processor.read_source(path)
+    expected = reference_transform(df.copy())
+    actual = excel_processor.transform_frame(df, workers=1)
+
+    for col in FLAG_COLUMNS + DERIVED_COLUMNS:
+        pd.testing.assert_series_equal(
+            actual[col], expected[col], check_dtype=False, check_names=False, obj=col
+        )
+    slots = sheet(actual, "Digitaal 2p+")[FAMILY_SLOTS]
+    pd.testing.assert_frame_equal(slots, reference_family_slots(expected), check_dtype=False)
+    np.testing.assert_array_equal(
+        sheet(actual, "MailChimp")["Lidmaatschapsnummer"].to_numpy(),
+        reference_mail_chimp(expected),
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_randomized_members_match_reference(tmp_path, seed):
+    assert_matches_reference(write_bron(tmp_path / "Bron.xlsx", randomized_rows(seed)))
+
+
+def member(contract, number, email, birthday, toorts=0, naam="Jansen", toevoeging=None):
+    return [
+        contract,
+        number,
+        "Anna",
+        None,
+        naam,
+        "Dorpsstraat",
+        contract,
+        toevoeging,
+        "1234 AB",
+        "Zeist",
+        "Nederland",
+        email,
+        birthday,
+        datetime.datetime(2020, 1, 1),
+        toorts,
+        "Ja",
+        "Ja",
+    ]
+
+
+def test_household_rules(tmp_path):
+    day = datetime.datetime
+    rows = [
+        # Contract 1: the second toorts member is not picked
+        member(1, 101, "een@example.nl", day(1980, 1, 1)),
+        member(1, 102, "een@example.nl", day(1990, 1, 1), toorts=1),
+        member(1, 103, "een@example.nl", day(1950, 1, 1), toorts=1),
+        # Contract 2: no toorts, the first of two equally old members
+        member(2, 201, "twee@example.nl", day(1970, 1, 1)),
+        member(2, 202, "twee@example.nl", day(1960, 1, 1)),
+        member(2, 203, "twee@example.nl", day(1960, 1, 1)),
+        # Contract 3: toorts 2 counts as a flag, so nobody gets the letter
+        member(3, 301, "drie@example.nl", day(1970, 1, 1)),
+        member(3, 302, "drie@example.nl", day(1960, 1, 1), toorts=2),
+        # Contract 4: no email, no naam, numeric toevoeging; a missing birth
+        # date counts as 01-01-1970
+        member(4, 401, None, None, naam=None, toevoeging=2),
+        member(4, 402, None, day(1960, 1, 1), toevoeging=2),
+    ]
+    path = write_bron(tmp_path / "Bron.xlsx", rows)
+    assert_matches_reference(path)
+
+    df = transform(path).set_index("abonneenummer")
+    assert list(df.index[df["fysiek 2p+ brieven"]]) == [102, 202, 402]
+    assert list(df.index[df["MailChimp"]]) == [102, 202, 302]
+    families = df[df["digitaal 2p+ family"]]
+    assert families["fam_number"].to_dict() == {101: 2, 103: 1, 201: 2, 203: 1, 301: 1}
+    assert not df.loc[[401, 402], ["MailChimp", "digitaal 2p+ family"]].any().any()
+    assert df.loc[401, "naam compleet"] == "Anna "
+    assert df.loc[401, "straat compleet"] == "Dorpsstraat 4 2"
+
+
+def test_sharded_classification_matches_serial(tmp_path):
+    path = write_bron(tmp_path / "Bron.xlsx", randomized_rows(7, rows=2000))
+    serial, sharded = transform(path, workers=1), transform(path, workers=2)
+    pd.testing.assert_frame_equal(serial, sharded)
+
+    workbooks = []
+    for df in (serial, sharded):
+        output = io.BytesIO()
+        excel_processor.write_workbook(excel_processor.build_sheets(df), output)
+        workbooks.append(zipfile.ZipFile(output))
+    # Only the creation time in docProps/core.xml differs between two writes
+    names = [name for name in workbooks[0].namelist() if name != "docProps/core.xml"]
+    assert names == [name for name in workbooks[1].namelist() if name != "docProps/core.xml"]
+    for name in names:
+        assert workbooks[0].read(name) == workbooks[1].read(name), name
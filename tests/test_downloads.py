@@ -0,0 +1,54 @@
+import pytest
+
+from app.downloads import RangeNotSatisfiable, parse_range
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=990-5000", (990, 999)),
+        ("bytes=999-999", (999, 999)),
+        (" bytes=0-0", None),
+        ("bytes= 10-20 ", (10, 20)),
+    ],
+)
+def test_single_range(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        None,
+        "",
+        "items=0-10",
+        "bytes=0-10,20-30",
+        "bytes=abc-10",
+        "bytes=10-abc",
+        "bytes=-",
+        # An end before the start is invalid, so the whole body is served
+        "bytes=500-100",
+        "bytes=5000-100",
+    ],
+)
+def test_ignored_range(header):
+    assert parse_range(header, SIZE) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=1000-1200", "bytes=-0"])
+def test_unsatisfiable_range(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, SIZE)
+
+
+def test_empty_body():
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=0-", 0)
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=-10", 0)